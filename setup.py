@@ -43,6 +43,7 @@ setup(
     long_description=read('README.rst'),
     scripts=['scripts/shaker',
              'scripts/shaker-terminate',
+             'scripts/shaker-ami-sync',
          ],
     install_requires=requirements,
 )
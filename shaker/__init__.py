@@ -5,20 +5,32 @@ from shaker.version import __version__
 
 import os
 import sys
-import time
+import copy
+import shutil
 import optparse
-import email.mime
-from tempfile import TemporaryFile
-from M2Crypto import BIO, RSA, m2
-import boto
-import boto.ec2
-from boto.ec2.blockdevicemapping import EBSBlockDeviceType, BlockDeviceMapping
+import tempfile
+import itertools
 import shaker.log
 import shaker.config
+import shaker.ec2
 import shaker.template
+import shaker.inventory
+import shaker.keypool
+import shaker.keys
+import shaker.manifest
+import shaker.pipeline
+import shaker.stats
+import shaker.terminate
+import shaker.trace
+import shaker.userdata
+import shaker.waiter
 LOG = shaker.log.getLogger(__name__)
-RUN_INSTANCE_TIMEOUT = 180  # seconds
 DEFAULT_MINION_PKI_DIR = '/etc/salt/pki/master/minions'
+LIVE_INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+# boto, jinja2 and yaml are imported by the code paths using them, so
+# that e.g. shaker --help and shaker-terminate start quickly.  See
+# util/startup_benchmark.py.
 
 # table takne from http://aws.amazon.com/ec2/instance-types/
 InstanceTypes = [
@@ -55,17 +67,76 @@ InstanceTypes = [
     ]
 
 
+class Minion(object):
+    """Minion - launch state for a single host: its profile config,
+    generated keys, rendered user data and the launched instance.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.public_key = None
+        self.private_key = None
+        self.user_data = None
+        self.instance = None
+        self.assigned_ip_address = None
+
+    def get_keyname(self):
+        if self.config.get('salt_id'):
+            keyname = self.config['salt_id']
+        elif self.config.get('hostname'):
+            if self.config.get('domain'):
+                keyname = "{0}.{1}".format(
+                    self.config['hostname'],
+                    self.config['domain'])
+            else:
+                keyname = self.config['hostname']
+        else:
+            keyname = None
+        return keyname
+
+
+def fsync_dir(path):
+    """Flush a directory's entries (e.g. renames) to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def expand_pattern(pattern, index, count):
+    """Return the name for host number ``index`` (1-based) of a
+    fleet.  A pattern may contain a format field, e.g. 'web{0:02d}';
+    otherwise the index is appended when launching more than one host.
+    """
+    if '{' in pattern:
+        return pattern.format(index)
+    if count > 1:
+        return "{0}{1}".format(pattern, index)
+    return pattern
+
+
 class EBSFactory(object):
     """EBSFactory - build and launch EBS salt minions.
     """
-    def __init__(self):
-        cli, config_dir, profile = self.parse_cli()
+    def __init__(self, cli=None, config_dir=None, profile=None,
+                 overrides=None, tracer=None):
+        """A tracer shared by several factories (e.g. for a manifest)
+        is saved by its owner, otherwise the trace is saved to the
+        --trace file.
+        """
+        if cli is None:
+            cli, config_dir, profile = parse_cli()
+        self.trace_file = None if tracer else cli.trace_file
+        self.tracer = tracer or shaker.trace.Tracer()
         self.profile = shaker.config.user_profile(
             cli,
             config_dir,
-            profile)
+            profile,
+            overrides)
         self.pki_dir = shaker.config.get_pki_dir(config_dir)
         self.userdata_dir = shaker.config.get_userdata_dir(config_dir)
+        self.userdata_store = shaker.userdata.UserDataStore(self.userdata_dir)
         self.dry_run = cli.dry_run
         self.write_user_data = cli.write_user_data
         self.minion_pki_dir = cli.minion_pki_dir or DEFAULT_MINION_PKI_DIR
@@ -73,253 +144,620 @@ class EBSFactory(object):
         self.config['config_dir'] = config_dir
         self.pre_seed = cli.pre_seed or self.config['pre_seed']
         self.ip_address = cli.ip_address or self.config['ip_address']
+        self.ip_addresses = self.get_ip_addresses()
         self.additional_tags = self.config['additional_tags']
         self.check_name_before_create = self.config['check_name_before_create']
         self.check_name_after_create = self.config['check_name_after_create']
+        self.count = self.config['count']
+        self.keypool_size = int(self.config['keypool_size'] or 0)
+        self.minions = []
+        self.compress_user_data = self.config['compress_user_data']
+        self.compressed_user_data = {}
+        self.block_map = None
+        self.show_stats = cli.show_stats
+        self.stats = None
+        self.addresses_in_use = {}
+        self.name_tags = {}
+        # Shared by a long-running daemon to keep connections warm.
+        self.connections = None
+        self.out = sys.stdout
+        self.inventory = shaker.inventory.Inventory(
+            config_dir,
+            self.config['ec2_region'],
+            ttl=int(self.config['inventory_ttl'] or 0),
+            metadata_ttl=int(self.config['metadata_ttl'] or 0),
+            offline=self.dry_run)
+        if cli.refresh_inventory:
+            self.inventory.invalidate()
 
     def process(self):
-        if self.pre_seed:
-            if not self.generate_minion_keys():
-                return False
-        self.user_data = self.build_mime_multipart()
-        if self.write_user_data or (
-            self.get_keyname() and not self.pre_seed and not self.dry_run):
-            self.write_user_data_to_file()
-        self.conn = self.get_connection()
-        if not self.conn:
-            errmsg = "Unable to establish a connection for: {0}".format(
-                self.config['ec2_region'])
-            LOG.error(errmsg)
-            return False
-        if not self.verify_settings():
+        try:
+            with self.tracer.span('process'):
+                return self.launch()
+        finally:
+            self.inventory.save()
+            self.userdata_store.save()
+            if self.trace_file:
+                self.tracer.save(self.trace_file)
+                print >>self.out, self.tracer.format_summary()
+            if self.show_stats and self.stats:
+                print >>self.out, self.stats.format_summary()
+                for limiter in shaker.ec2.limiters():
+                    print >>self.out, limiter.format_summary()
+
+    def launch(self):
+        """Launch the minions.  The phases of the launch run as a
+        dependency graph (see shaker.pipeline): keys and user data are
+        prepared while settings are verified with EC2, and instances
+        are tagged while waiting for them to run.
+        """
+        with self.tracer.span('minions'):
+            self.minions = self.get_minions()
+        if not self.minions:
             return False
-        if self.dry_run:
-            return True
+        pipeline = shaker.pipeline.Pipeline(tracer=self.tracer)
+        render_requires = []
         if self.pre_seed:
-            self.pre_seed_minion()
-        self.launch_instance()
-        assigned_ip_address = None
-        if self.ip_address:
-            ip_in_use = self.ip_address_in_use()
-            if ip_in_use:
-                errmsg = "Unable to assign ip address {0}, " \
-                         "already in use with instance {1}".format(
-                    self.ip_address, ip_in_use.id)
-                LOG.error(errmsg)
-            else:
-                self.conn.associate_address(self.instance.id, self.ip_address)
-                assigned_ip_address = self.ip_address
+            pipeline.add('keys', self.generate_minion_keys)
+            render_requires.append('keys')
+            if self.keypool_size and not self.dry_run:
+                pipeline.add('refill', self.refill_keypool, ['keys'])
+        pipeline.add('render', self.render_user_data, render_requires)
+        pipeline.add('connect', self.connect)
+        pipeline.add('verify', self.verify, ['connect'])
+        if not self.dry_run:
+            pipeline.add('image', self.prepare_block_device_map, ['verify'])
+            pipeline.add('names', self.prefetch_names, ['verify'])
+            pipeline.add('addresses', self.prefetch_addresses, ['verify'])
+            launch_requires = ['render', 'verify', 'image', 'names', 'addresses']
+            if self.pre_seed:
+                pipeline.add('pre_seed', self.pre_seed_all, ['render', 'verify'])
+                launch_requires.append('pre_seed')
+            pipeline.add('launch', self.launch_instances, launch_requires)
+            pipeline.add('tag', self.tag_instances, ['launch'])
+            pipeline.add('wait', self.wait_for_instances, ['launch'])
+        try:
+            ok = pipeline.run()
+        finally:
+            # Also when a phase raised: the keys of minions which never
+            # launched must not stay accepted on the master.
+            failed = [m for m in self.minions if not m.instance]
+            if failed and pipeline.results.get('pre_seed'):
+                self.remove_pre_seeded_keys(failed)
+        if self.dry_run:
+            return ok
+        if len(failed) == len(self.minions):
+            return False
         if self.config['assign_dns']:
             LOG.info("assign_dns not yet implemented") #XXX Not yet implemented
             self.assign_dns(self.config['assign_dns'])
-        self.output_response_to_user(assigned_ip_address)
-        return True
+        for minion in self.minions:
+            if minion.instance:
+                self.output_response_to_user(minion)
+        return not failed
+
+    def get_ip_addresses(self):
+        """Return the elastic ip addresses to assign, in host order.
+        ip_address may be a list or a comma-separated string.
+        """
+        if not self.ip_address:
+            return []
+        if isinstance(self.ip_address, basestring):
+            return [ip.strip() for ip in self.ip_address.split(',') if ip.strip()]
+        return list(self.ip_address)
+
+    def assign_ip_address(self, minion, ip_address):
+        """Associate the elastic ip address with the minion's
+        instance, unless the address is in use by a running instance.
+        """
+        if ip_address in self.addresses_in_use:
+            errmsg = "Unable to assign ip address {0}, " \
+                     "already in use with instance {1}".format(
+                ip_address, self.addresses_in_use[ip_address])
+            LOG.error(errmsg)
+            return
+        self.conn.associate_address(minion.instance.id, ip_address)
+        minion.assigned_ip_address = ip_address
+        self.inventory.update('addresses', ip_address, minion.instance.id)
+
+    def get_minions(self):
+        """Return a Minion for each host to launch.  The hostname
+        and salt_id are expanded from patterns for each host of the
+        fleet, see expand_pattern().
+        """
+        try:
+            count = int(self.count or 1)
+        except ValueError:
+            LOG.error("Invalid count: {0}".format(self.count))
+            return []
+        if count < 1:
+            LOG.error("Invalid count: {0}".format(count))
+            return []
+        minions = []
+        for index in range(1, count + 1):
+            config = dict(self.config)
+            for key in ['hostname', 'salt_id']:
+                if config.get(key):
+                    try:
+                        config[key] = expand_pattern(config[key], index, count)
+                    except (KeyError, IndexError, ValueError):
+                        LOG.error("Invalid {0} pattern: {1}".format(
+                            key, config[key]))
+                        return []
+            minions.append(Minion(config))
+        return minions
 
     def get_connection(self):
         conn_params = {
             'aws_access_key_id': self.config['ec2_access_key_id'],
             'aws_secret_access_key': self.config['ec2_secret_access_key'],
         }
+        key = (self.config['ec2_region'], self.config['ec2_access_key_id'])
+        if self.connections is not None and key in self.connections:
+            return self.connections[key]
+        import boto.exception
         try:
-            conn = boto.ec2.connect_to_region(self.config['ec2_region'], **conn_params)
+            with self.tracer.span('connect_to_region', 'ec2'):
+                conn = shaker.ec2.connect(
+                    self.config['ec2_region'],
+                    rate=float(self.config['ec2_request_rate'] or 0),
+                    max_retries=int(self.config['ec2_max_retries'] or 0),
+                    **conn_params)
         except boto.exception.BotoClientError as e:
             errmsg = "Unable to connect to the region {0}: {1}".format(
                     self.config['ec2_region'], e.reason)
             LOG.error(errmsg)
             conn = None
+        if self.connections is not None and conn:
+            self.connections[key] = conn
         return conn
 
+    def connect(self):
+        conn = self.get_connection()
+        if not conn:
+            errmsg = "Unable to establish a connection for: {0}".format(
+                self.config['ec2_region'])
+            LOG.error(errmsg)
+            return False
+        # The copy shares the connection's state, including the warm
+        # HTTP connections of a daemon, but records its own calls.
+        conn = copy.copy(conn)
+        self.stats = shaker.stats.instrument(conn)
+        self.conn = shaker.trace.TracedConnection(conn, self.tracer)
+        return True
+
     def verify(self):
         if not self.verify_settings():
             return False
-        if self.check_name_before_create and self.running_host_with_same_tag():
-            return False
+        if self.check_name_before_create:
+            in_use = self.names_in_use(self.get_hostnames())
+            if in_use:
+                LOG.error("Name tag already in use: {0}".format(
+                    ', '.join(sorted(in_use))))
+                return False
         return True
 
-    def launch_instance(self):
-        if not self.verify():
-            return
-        is_instance_store = self.conn.get_all_images(self.config['ec2_ami_id'], filters={'root-device-type': 'instance-store'})
-        if is_instance_store:
-            block_map = None
-        else:
-            block_map = BlockDeviceMapping()
-            root_device = self.config['ec2_root_device']
-            block_map[root_device] = EBSBlockDeviceType()
-            if self.config['ec2_size']:
-                block_map[root_device].size = self.config['ec2_size']
-            block_map[root_device].delete_on_termination = True
-        reservation = self.conn.run_instances(
-            self.config['ec2_ami_id'],
-            key_name=self.config['ec2_key_name'],
-            security_groups=self.config['ec2_security_groups'] or [self.config['ec2_security_group']],
-            instance_type=self.config['ec2_instance_type'],
-            placement=self.config['ec2_zone'],
-            placement_group=self.config['ec2_placement_group'],
-            monitoring_enabled=self.config['ec2_monitoring_enabled'],
-            block_device_map=block_map,
-            user_data=self.user_data)
-        self.instance = reservation.instances[0]
-        self.add_tags(self.instance)
-        secs = RUN_INSTANCE_TIMEOUT
-        rest_interval = 5
-        while secs and not self.instance.state == 'running':
-            time.sleep(rest_interval)
-            secs = secs - rest_interval
+    def get_hostnames(self):
+        return [m.config['hostname'] for m in self.minions
+                if m.config['hostname']]
+
+    def render_user_data(self):
+        """Render the user data of every minion, writing it to the
+        user data directory when requested.
+        """
+        user_data = shaker.template.BatchUserData(
+            m.config for m in self.minions)
+        for minion, payload in itertools.izip(self.minions, user_data):
+            minion.user_data = payload
+            if self.write_user_data or (
+                minion.get_keyname() and not self.pre_seed and not self.dry_run):
+                self.write_user_data_to_file(minion)
+            if self.compress_user_data:
+                minion.user_data = self.compress(payload)
+        return self.verify_user_data()
+
+    def refill_keypool(self):
+        shaker.keypool.refill_in_background(
+            self.config['config_dir'],
+            self.keypool_size,
+            int(self.config['key_size']),
+            self.config['key_backend'])
+        return True
+
+    def prepare_block_device_map(self):
+        self.block_map = self.get_block_device_map()
+        return True
+
+    def prefetch_names(self):
+        """Resolve all Name tags in one lookup, before tagging.
+        """
+        if self.check_name_after_create:
+            self.names_in_use(self.get_hostnames())
+        return True
+
+    def prefetch_addresses(self):
+        if self.ip_addresses:
+            self.addresses_in_use = self.ip_addresses_in_use(self.ip_addresses)
+        return True
+
+    def pre_seed_all(self):
+        return self.pre_seed_minions(self.minions)
+
+    def launch_instances(self):
+        """Launch all minions, batching hosts with identical user
+        data into a single run_instances call.
+        """
+        import uuid
+        import boto.exception
+        block_map = self.block_map
+        for user_data, minions in self.group_by_user_data():
             try:
-                self.instance.update()
-            except boto.exception.EC2ResponseError:
-                pass
-        if secs <= 0:
-            errmsg = "run instance {0} failed after {1} seconds".format(
-                self.instance.id, RUN_INSTANCE_TIMEOUT)
-            LOG.error(errmsg)
+                # The client token makes the call safe to retry.
+                reservation = self.conn.run_instances(
+                    self.config['ec2_ami_id'],
+                    min_count=len(minions),
+                    max_count=len(minions),
+                    key_name=self.config['ec2_key_name'],
+                    security_groups=self.config['ec2_security_groups'] or [self.config['ec2_security_group']],
+                    instance_type=self.config['ec2_instance_type'],
+                    placement=self.config['ec2_zone'],
+                    placement_group=self.config['ec2_placement_group'],
+                    monitoring_enabled=self.config['ec2_monitoring_enabled'],
+                    block_device_map=block_map,
+                    user_data=user_data,
+                    client_token=uuid.uuid4().hex)
+            except boto.exception.BotoServerError, err:
+                LOG.error("Unable to launch {0}: {1}".format(
+                    ', '.join(m.get_keyname() or '(unnamed)' for m in minions),
+                    err.error_message or err.reason))
+                continue
+            for minion, instance in zip(minions, reservation.instances):
+                minion.instance = instance
+        instances = [m.instance for m in self.minions if m.instance]
+        if not instances:
+            return False
+        shaker.terminate.record_instance_regions(
+            self.config['config_dir'],
+            [i.id for i in instances],
+            self.config['ec2_region'])
+        return True
+
+    def tag_instances(self):
+        for minion in self.minions:
+            if minion.instance:
+                self.add_tags(minion)
+        return True
+
+    def wait_for_instances(self):
+        """Wait for the launched instances to be running, assigning
+        each one its elastic ip address as soon as it is.
+        """
+        launched = [m for m in self.minions if m.instance]
+        minions = dict((m.instance.id, m) for m in launched)
+        ip_addresses = dict(
+            (m.instance.id, ip_address)
+            for m, ip_address in zip(self.minions, self.ip_addresses)
+            if m.instance)
+        for instance in self.wait_for_running([m.instance for m in launched]):
+            self.inventory.add_instance(instance)
+            if instance.id in ip_addresses:
+                self.assign_ip_address(
+                    minions[instance.id], ip_addresses[instance.id])
+        return True
+
+    def get_image_metadata(self, ami_id):
+        """Return a dict of the image attributes shaker uses, from
+        the inventory when possible, or None if there's no such image.
+        """
+        found, metadata = self.inventory.lookup('images', ami_id)
+        if found and 'architecture' in metadata:
+            return metadata
+        images = self.conn.get_all_images([ami_id])
+        if not images:
+            return None
+        image = images[0]
+        block_devices = {}
+        for device, bdt in (image.block_device_mapping or {}).items():
+            block_devices[device] = {
+                'snapshot_id': bdt.snapshot_id,
+                'size': bdt.size,
+                'volume_type': getattr(bdt, 'volume_type', None),
+                'delete_on_termination': bdt.delete_on_termination,
+            }
+        metadata = {
+            'root_device_type': image.root_device_type,
+            'root_device_name': image.root_device_name,
+            'architecture': image.architecture,
+            'virtualization_type': getattr(image, 'virtualization_type', None),
+            'block_device_mapping': block_devices,
+        }
+        self.inventory.update('images', ami_id, metadata)
+        return metadata
+
+    def get_block_device_map(self):
+        metadata = self.get_image_metadata(self.config['ec2_ami_id'])
+        if metadata and metadata['root_device_type'] == 'instance-store':
+            return None
+        from boto.ec2.blockdevicemapping import BlockDeviceMapping
+        from boto.ec2.blockdevicemapping import EBSBlockDeviceType
+        block_map = BlockDeviceMapping()
+        root_device = self.config['ec2_root_device']
+        block_map[root_device] = EBSBlockDeviceType()
+        if self.config['ec2_size']:
+            block_map[root_device].size = self.config['ec2_size']
+        block_map[root_device].delete_on_termination = True
+        return block_map
 
-    def add_tags(self, instance):
-        if self.config['hostname']:
-            self.assign_name_tag()
+    def group_by_user_data(self):
+        """Return a list of (user_data, minions) pairs, in launch
+        order, for minions sharing the same rendered user data.
+        """
+        groups = []
+        index = {}
+        for minion in self.minions:
+            if minion.user_data not in index:
+                index[minion.user_data] = len(groups)
+                groups.append((minion.user_data, []))
+            groups[index[minion.user_data]][1].append(minion)
+        return groups
+
+    def wait_for_running(self, instances):
+        """Yield the instances as they reach the running state.  The
+        timeout is set by run_instance_timeout.
+        """
+        waiter = shaker.waiter.InstanceWaiter(
+            self.conn,
+            timeout=int(self.config['run_instance_timeout']))
+        return waiter.wait(instances)
+
+    def add_tags(self, minion):
+        if minion.config['hostname']:
+            self.assign_name_tag(minion)
         for name, tag in self.additional_tags.items():
-            instance.add_tag(name, tag)
+            with self.tracer.span('create_tags', 'ec2'):
+                minion.instance.add_tag(name, tag)
 
-    def output_response_to_user(self, assigned_ip_address):
-        msg1 = "Started Instance: {0}\n".format(self.instance.id)
+    def output_response_to_user(self, minion):
+        instance = minion.instance
+        assigned_ip_address = minion.assigned_ip_address
+        msg1 = "Started Instance: {0}\n".format(instance.id)
         LOG.info(msg1)
-        print msg1
+        print >>self.out, msg1
         p = int(self.config['ssh_port'])
         port = str(p) if p and not p == 22 else ''
         ## change user to 'root' for all non-Ubuntu systems
         user = self.config['sudouser'] if self.config['sudouser'] and self.config['ssh_import'] else 'ubuntu'
-        address = assigned_ip_address if assigned_ip_address else self.instance.public_dns_name
+        address = assigned_ip_address if assigned_ip_address else instance.public_dns_name
         # TODO: replace public dns with fqdn, where appropriate
         msg2 = "To access: ssh {0}{1}@{2}\n".format(
             '-p {0} '.format(port) if port else '',
             user,
             address)
         msg3 = "To terminate: shaker-terminate {0}".format(
-                   self.instance.id)
+                   instance.id)
         LOG.info(msg2)
         LOG.info(msg3)
-        print msg2
-        print msg3
+        print >>self.out, msg2
+        print >>self.out, msg3
 
-    def write_user_data_to_file(self):
-        keyname = self.get_keyname()
+    def write_user_data_to_file(self, minion):
+        keyname = minion.get_keyname()
         if keyname:
-            pathname = os.path.join(self.userdata_dir, keyname)
-            with open(pathname, 'w') as f:
-                f.write('{0}\n'.format(self.user_data))
+            pathname = self.userdata_store.add(
+                keyname, '{0}\n'.format(minion.user_data))
             LOG.info("user data written to {0}".format(pathname))
         else:
             LOG.error("unable to determine salt_id: specify hostname")
 
-    def pre_seed_minion(self):
+    def pre_seed_minion(self, minion):
         """Pre-seed minion keys, updating /etc/salt/pki/minion
         """
+        return self.pre_seed_minions([minion])
+
+    def pre_seed_minions(self, minions):
+        """Pre-seed the minions' public keys on the salt master.
+
+        The keys are written and synced in a hidden staging directory
+        inside minion_pki_dir (salt ignores dotfiles), then renamed
+        into place, followed by a single sync of the directory.  The
+        master never sees a partially written key.
+        """
         if not os.access(self.minion_pki_dir, os.W_OK | os.X_OK):
             errmsg = "directory not writeable: {0}".format(self.minion_pki_dir)
             LOG.error(errmsg)
             return False
-        keyname = self.get_keyname()
-        minionpubkey_pathname = os.path.join(
-            self.minion_pki_dir,
-            keyname)
-        with open(minionpubkey_pathname, 'w') as f:
-            f.write(self.public_key)
+        staging_dir = tempfile.mkdtemp(prefix='.shaker-', dir=self.minion_pki_dir)
+        try:
+            for minion in minions:
+                with open(os.path.join(staging_dir, minion.get_keyname()), 'w') as f:
+                    f.write(minion.public_key)
+                    f.flush()
+                    os.fsync(f.fileno())
+            for minion in minions:
+                keyname = minion.get_keyname()
+                os.rename(
+                    os.path.join(staging_dir, keyname),
+                    os.path.join(self.minion_pki_dir, keyname))
+            fsync_dir(self.minion_pki_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
         return True
 
-    def get_keyname(self):
-        if self.config.get('salt_id'):
-            keyname = self.config['salt_id']
-        elif self.config.get('hostname'):
-            if self.config.get('domain'):
-                keyname = "{0}.{1}".format(
-                    self.config['hostname'],
-                    self.config['domain'])
-            else:
-                keyname = self.config['hostname']
-        else:
-            keyname = None
-        return keyname
+    def remove_pre_seeded_keys(self, minions):
+        """Remove the pre-seeded keys of minions that failed to
+        launch.
+        """
+        for minion in minions:
+            path = os.path.join(self.minion_pki_dir, minion.get_keyname())
+            try:
+                os.unlink(path)
+                LOG.info("removed pre-seeded key {0}".format(path))
+            except OSError:
+                pass
+        fsync_dir(self.minion_pki_dir)
+
+    def ip_address_in_use(self, ip_address=None):
+        """If the ip_address is in use, return the associated instance
+        id, otherwise return None.
+        """
+        ip_address = ip_address or self.ip_addresses[0]
+        return self.ip_addresses_in_use([ip_address]).get(ip_address)
 
-    def ip_address_in_use(self):
-        """If the ip_address is in use, return associated instance,
-        otherwise return None.
+    def ip_addresses_in_use(self, ip_addresses):
+        """Return a dict mapping each of the ip addresses that is
+        associated with a running instance to the instance id.  The
+        addresses not in the inventory are looked up server-side, in
+        a single request.
         """
-        for instances in [r.instances for r in self.conn.get_all_instances()]:
-            for i in instances:
-                if i.ip_address == self.ip_address and i.state == 'running':
-                    return i
-        return None
+        in_use = {}
+        unknown = []
+        for ip_address in ip_addresses:
+            found, instance_id = self.inventory.lookup('addresses', ip_address)
+            if not found:
+                unknown.append(ip_address)
+            elif instance_id:
+                in_use[ip_address] = instance_id
+        if not unknown:
+            return in_use
+        reservations = self.conn.get_all_instances(
+            filters={
+                'ip-address': unknown,
+                'instance-state-name': 'running',
+            })
+        for reservation in reservations:
+            for i in reservation.instances:
+                in_use[i.ip_address] = i.id
+                self.inventory.add_instance(i)
+        # Only a completed lookup may record an address as free.
+        for ip_address in unknown:
+            if ip_address not in in_use:
+                self.inventory.update('addresses', ip_address, None)
+        return in_use
 
     def generate_minion_keys(self):
-        #XXX TODO: Replace M2Crypto with PyCrypto
-        # see: https://github.com/saltstack/salt/pull/1112/files
-        # generate keys
-        keyname = self.get_keyname()
-        if not keyname:
+        """Generate key pairs for all minions, claiming them from the
+        key pool when keypool_size is set.  Keys not in the pool are
+        generated together, in parallel.  A dry run leaves the pool
+        alone, generating throwaway keys.
+        """
+        keynames = [m.get_keyname() for m in self.minions]
+        if not all(keynames):
             LOG.error("Must specify salt_id or hostname")
             return False
-        gen = RSA.gen_key(2048, 1, callback=lambda x,y,z:None)
+        key_size = int(self.config['key_size'])
+        keys = {}
+        if self.keypool_size and not self.dry_run:
+            for keyname in keynames:
+                claimed = shaker.keypool.claim(self.pki_dir, key_size)
+                if not claimed:
+                    LOG.info("key pool empty, generating remaining keys")
+                    break
+                keys[keyname] = shaker.keys.key_material(*claimed)
+        try:
+            keys.update(shaker.keys.generate_key_pairs(
+                [k for k in keynames if k not in keys],
+                bits=key_size,
+                backend=self.config['key_backend']))
+        except ValueError, err:
+            LOG.error(str(err))
+            return False
+        for minion in self.minions:
+            self.save_minion_keys(minion, keys[minion.get_keyname()])
+        return True
+
+    def save_minion_keys(self, minion, keys):
+        keyname = minion.get_keyname()
+        public_key = keys['public_key']
+        private_key = keys['private_key']
         pubpath = os.path.join(self.pki_dir,
                                '{0}.pub'.format(keyname))
-        gen.save_pub_key(pubpath)
+        with open(pubpath, 'w') as f:
+            f.write(public_key)
         LOG.info("public key {0}".format(pubpath))
         if self.config.get('save_keys'):
             cumask = os.umask(191)
-            gen.save_key(
-                os.path.join(
+            with open(os.path.join(
                     self.pki_dir,
-                    '{0}.pem'.format(keyname)),
-                None)
+                    '{0}.pem'.format(keyname)), 'w') as f:
+                f.write(private_key)
             os.umask(cumask)
-        # public key
-        _pub = TemporaryFile()
-        bio_pub = BIO.File(_pub)
-        m2.rsa_write_pub_key(gen.rsa, bio_pub._ptr())
-        _pub.seek(0)
-        self.config['public_key'] = self.public_key = _pub.read()
-        self.config['formatted_public_key'] = '\n'.join(
-            "    {0}".format(k) for k in self.public_key.split('\n'))
-        # private key
-        _pem = TemporaryFile()
-        bio_pem = BIO.File(_pem)
-        gen.save_key_bio(bio_pem, None)
-        _pem.seek(0)
-        self.config['private_key'] = self.private_key = _pem.read()
-        self.config['formatted_private_key'] = '\n'.join(
-            "    {0}".format(k) for k in self.private_key.split('\n'))
-        return True
+        minion.config.update(keys)
+        minion.public_key = public_key
+        minion.private_key = private_key
 
-    def running_host_with_same_tag(self):
-        tag = self.config['hostname']
-        for reservation in self.conn.get_all_instances():
-            for i in reservation.instances:
-                if tag == i.tags.get('Name'):
-                    return True
-        return False
+    def running_host_with_same_tag(self, tag):
+        return tag in self.names_in_use([tag])
+
+    def names_in_use(self, names):
+        """Return the set of names used as the Name tag of a live
+        instance.  Names are looked up with a single filtered request
+        and remembered for the rest of the run, so the before-create
+        and after-create checks share one lookup.  Names found in the
+        inventory need no request at all.
+        """
+        unknown = []
+        for name in names:
+            if name in self.name_tags:
+                continue
+            found, instance_id = self.inventory.lookup('names', name)
+            if found:
+                self.name_tags[name] = instance_id
+            else:
+                unknown.append(name)
+        if unknown:
+            reservations = self.conn.get_all_instances(
+                filters={
+                    'tag:Name': unknown,
+                    'instance-state-name': LIVE_INSTANCE_STATES,
+                })
+            found = {}
+            for reservation in reservations:
+                for i in reservation.instances:
+                    name = i.tags.get('Name')
+                    if name in unknown:
+                        found[name] = i.id
+                    self.inventory.add_instance(i)
+            # Only a completed lookup may record a name as free.
+            for name in unknown:
+                self.name_tags[name] = found.get(name)
+                if name not in found:
+                    self.inventory.update('names', name, None)
+        return set(n for n in names if self.name_tags.get(n))
 
-    def assign_name_tag(self):
+    def assign_name_tag(self, minion):
         """Assign the 'Name' tag to the instance, but only if it
         isn't already in use.
         """
-        if self.check_name_after_create and self.running_host_with_same_tag():
+        tag = minion.config['hostname']
+        if self.check_name_after_create and self.running_host_with_same_tag(tag):
+            LOG.warning("Name tag {0} already in use, not assigned to {1}".format(
+                tag, minion.instance.id))
             return
-        tag = self.config['hostname']
-        self.instance.add_tag('Name', tag)
-
-    def build_mime_multipart(self):
-        userData = shaker.template.UserData(self.config)
-        outer = email.mime.multipart.MIMEMultipart()
-        for content, subtype, filename in [
-            (userData.user_script, 'x-shellscript', 'user-script.txt'),
-            (userData.cloud_init, 'cloud-config', 'cloud-config.txt'),
-            (userData.boothook_script, 'cloud-boothook', 'boothook-script.txt'),]:
-            msg = email.mime.text.MIMEText(content, _subtype=subtype)
-            msg.add_header('Content-Disposition',
-                           'attachment',
-                           filename=filename)
-            outer.attach(msg)
-        return outer.as_string()
+        with self.tracer.span('create_tags', 'ec2'):
+            minion.instance.add_tag('Name', tag)
+        self.inventory.update('names', tag, minion.instance.id)
+
+    def compress(self, payload):
+        """Return the gzip-compressed user data, logging the raw and
+        compressed size of each part.  Equal payloads are compressed
+        once.
+        """
+        if payload not in self.compressed_user_data:
+            for filename, raw, compressed in shaker.template.part_sizes(payload):
+                LOG.info("user data {0}: {1} bytes, {2} compressed".format(
+                    filename, raw, compressed))
+            compressed = shaker.template.gzip_compress(payload)
+            LOG.info("user data: {0} bytes, {1} compressed".format(
+                len(payload), len(compressed)))
+            self.compressed_user_data[payload] = compressed
+        return self.compressed_user_data[payload]
+
+    def get_key_pair_names(self):
+        found, key_pairs = self.inventory.lookup('key_pairs', 'names')
+        if not found:
+            key_pairs = [kp.name for kp in self.conn.get_all_key_pairs()]
+            self.inventory.update('key_pairs', 'names', key_pairs)
+        return key_pairs
 
     def verify_settings(self):
         if not self.config['ec2_ami_id']:
@@ -328,15 +766,17 @@ class EBSFactory(object):
         if not self.config['ec2_key_name']:
             # If no key pair has been specified, just use the first one,
             # if it's the only key pair.  Otherwise the user must specify.
-            key_pairs = self.conn.get_all_key_pairs()
+            key_pairs = self.get_key_pair_names()
             if len(key_pairs) < 1:
-                LOG.error("No key pair available for region: {0}" % self.conn)
+                LOG.error("No key pair available for region: {0}".format(
+                    self.config['ec2_region']))
+                return False
             elif len(key_pairs) > 1:
                 errmsg = "Must specify ec2-key or ec2_key_name: {0}".format(
-                    ', '.join([kp.name for kp in key_pairs]))
+                    ', '.join(key_pairs))
                 LOG.error(errmsg)
                 return False
-            self.config['ec2_key_name'] = [kp.name for kp in key_pairs][0]
+            self.config['ec2_key_name'] = key_pairs[0]
         if self.config['ec2_size']:
             try:
                 self.config['ec2_size'] = int(self.config['ec2_size'])
@@ -344,120 +784,198 @@ class EBSFactory(object):
                 LOG.error("Invalid ec2_size: {0}".format(
                     self.config['ec2_size']))
                 return False
+        if len(self.ip_addresses) > len(self.minions):
+            LOG.error("More ip addresses than instances: {0}".format(
+                ', '.join(self.ip_addresses)))
+            return False
         if not self.config['ec2_instance_type'] in InstanceTypes:
             LOG.error("Invalid ec2_instance_type: {0}".format(
                 self.config['ec2_instance_type']))
             return False
         return True
 
-    def parse_cli(self):
-        parser = optparse.OptionParser(
-            usage="%prog [options] profile",
-            version="%%prog {0}".format(__version__))
-        parser.add_option(
-            '-a', '--ami', dest='ec2_ami_id', metavar='AMI',
-            help='Build instance from AMI')
-        parser.add_option(
-            '--release', dest='release',
-            metavar='UBUNTU_RELEASE', default='',
-            help="Ubuntu release (precise, lucid, etc.)")
-        parser.add_option('--ec2-group', dest='ec2_security_group')
-        parser.add_option('--ec2-key', dest='ec2_key_name')
-        parser.add_option('--ec2-region', dest='ec2_region',
-                          help="Region to use: us-east-1, etc.")
-        parser.add_option('--ec2-zone', dest='ec2_zone',
-                          help="Availability zone to use: us-east-1b, etc.")
-        parser.add_option('--instance-type', dest='ec2_instance_type',
-                          help="One of t1.micro, m1.small, ...")
-        parser.add_option('--placement-group', dest='ec2_placement_group')
-        parser.add_option(
-            '--config-dir', dest='config_dir',
-            help="Configuration directory")
-        parser.add_option(
-            '--user-data', dest='user_data_template',
-            help="User data template file")
-        parser.add_option(
-            '--cloud-init', dest='cloud_init_template',
-            help="cloud-init template file")
-        parser.add_option(
-            '--minion-template', dest='minion_template',
-            help="Minion template file")
-        parser.add_option(
-            '--boothook-template', dest='boothook_template',
-            help="Boothook template file")
-        parser.add_option(
-            '--dry-run', dest='dry_run',
-            action='store_true', default=False,
-            help="Log the initialization setup, but don't launch the instance")
-        parser.add_option(
-            '-m', '--master', dest='salt_master',
-            metavar='SALT_MASTER', default='',
-            help="Connect salt minion to SALT_MASTER")
-        parser.add_option(
-            '--grains', dest='salt_grains',
-            metavar='SALT_GRAINS', default='',
-            help="Assign SALT_GRAINS to salt minion, semicolon separated list of key:value,value2")
-        parser.add_option(
-            '--pillar_roots', dest='salt_pillar_roots_dir',
-            metavar='SALT_PILLAR_ROOTS', default='',
-            help="Assign SALT_PILLAR_ROOTS to salt minion, path as string")
-        
-        parser.add_option(
-            '--hostname', dest='hostname',
-            metavar='HOSTNAME', default='',
-            help="Assign HOSTNAME to salt minion")
-        parser.add_option(
-            '--domain', dest='domain',
-            metavar='DOMAIN', default='',
-            help="Assign DOMAIN name to salt minion")
-        parser.add_option(
-            '--ip_address', dest='ip_address',
-            metavar='IP_ADDRESS', default='',
-            help="Assign elastic IP address to salt minion")
-        parser.add_option(
-            '--preseed', dest='pre_seed',
-            action='store_true', default=False,
-            help="Pre-seed the minion keys")
-        parser.add_option(
-            '--save-keys', dest='save_keys',
-            action='store_true', default=False,
-            help="Save keys locally, including the pre-seeded private key")
-        parser.add_option(
-            '--minion-pki-dir', dest='minion_pki_dir',
-            metavar='PKI_DIR', default=DEFAULT_MINION_PKI_DIR,
-            help="Minion PKI_DIR, when pre-seeding minion keys")
-        parser.add_option(
-            '-w', '--write-user-data', dest='write_user_data',
-            action='store_true', default=False,
-            help="Write user-data to USERDATA directory (~/.shaker/userdata)")
-        import shaker.log
-        parser.add_option('-l',
-                '--log-level',
-                dest='log_level',
-                default='info',
-                choices=shaker.log.LOG_LEVELS.keys(),
-                help='Log level: {0}.  \nDefault: %%default'.format(
-                     ', '.join(shaker.log.LOG_LEVELS.keys()))
-                )
-        (opts, args) = parser.parse_args()
-        if len(args) < 1:
-            if opts.ec2_ami_id or opts.release:
-                profile = None
-            else:
-                print parser.format_help().strip()
-                errmsg = "\nError: Specify shaker profile or EC2 ami or Ubuntu release"
-                raise SystemExit(errmsg)
-        else:
-            profile = args[0]
-        import shaker.config
-        config_dir = shaker.config.get_config_dir(opts.config_dir)
-        shaker.log.start_logger(
-            __name__,
-            os.path.join(config_dir, 'shaker.log'),
-            opts.log_level)
-        if opts.ec2_ami_id:
-            opts.distro = ''  # mutually exclusive
+    def verify_user_data(self):
+        for minion in self.minions:
+            size = len(minion.user_data or '')
+            if size > shaker.template.USER_DATA_LIMIT:
+                errmsg = "User data for {0} is {1} bytes, over the " \
+                         "limit of {2}".format(
+                    minion.get_keyname() or 'instance',
+                    size,
+                    shaker.template.USER_DATA_LIMIT)
+                if not self.compress_user_data:
+                    errmsg += "; try compress_user_data"
+                LOG.error(errmsg)
+                return False
+        return True
+
+
+# Options naming files, resolved against the caller's working
+# directory.  Templates not found there are looked up in the template
+# directory, see shaker.template.UserData.find_template.
+PATH_OPTIONS = ['config_dir', 'minion_pki_dir', 'manifest', 'trace_file']
+TEMPLATE_OPTIONS = ['user_data_template', 'cloud_init_template',
+                    'minion_template', 'boothook_template']
+
+
+def resolve_paths(opts, cwd):
+    for dest in PATH_OPTIONS + TEMPLATE_OPTIONS:
+        value = getattr(opts, dest)
+        if not value or os.path.isabs(value):
+            continue
+        path = os.path.join(cwd, os.path.expanduser(value))
+        if dest in PATH_OPTIONS or os.path.isfile(path):
+            setattr(opts, dest, path)
+
+
+def parse_cli(args=None, cwd=None):
+    """Parse the command line.  With cwd (e.g. the working directory
+    of a daemon's client), relative paths are resolved against it.
+    """
+    parser = optparse.OptionParser(
+        usage="%prog [options] profile",
+        version="%%prog {0}".format(__version__))
+    parser.add_option(
+        '-a', '--ami', dest='ec2_ami_id', metavar='AMI',
+        help='Build instance from AMI')
+    parser.add_option(
+        '--release', dest='release',
+        metavar='UBUNTU_RELEASE', default='',
+        help="Ubuntu release (precise, lucid, etc.)")
+    parser.add_option('--ec2-group', dest='ec2_security_group')
+    parser.add_option('--ec2-key', dest='ec2_key_name')
+    parser.add_option('--ec2-region', dest='ec2_region',
+                      help="Region to use: us-east-1, etc.")
+    parser.add_option('--ec2-zone', dest='ec2_zone',
+                      help="Availability zone to use: us-east-1b, etc.")
+    parser.add_option('--instance-type', dest='ec2_instance_type',
+                      help="One of t1.micro, m1.small, ...")
+    parser.add_option('--placement-group', dest='ec2_placement_group')
+    parser.add_option(
+        '--config-dir', dest='config_dir',
+        help="Configuration directory")
+    parser.add_option(
+        '--user-data', dest='user_data_template',
+        help="User data template file")
+    parser.add_option(
+        '--cloud-init', dest='cloud_init_template',
+        help="cloud-init template file")
+    parser.add_option(
+        '--minion-template', dest='minion_template',
+        help="Minion template file")
+    parser.add_option(
+        '--boothook-template', dest='boothook_template',
+        help="Boothook template file")
+    parser.add_option(
+        '--dry-run', dest='dry_run',
+        action='store_true', default=False,
+        help="Log the initialization setup, but don't launch the instance")
+    parser.add_option(
+        '-m', '--master', dest='salt_master',
+        metavar='SALT_MASTER', default='',
+        help="Connect salt minion to SALT_MASTER")
+    parser.add_option(
+        '--grains', dest='salt_grains',
+        metavar='SALT_GRAINS', default='',
+        help="Assign SALT_GRAINS to salt minion, semicolon separated list of key:value,value2")
+    parser.add_option(
+        '--pillar_roots', dest='salt_pillar_roots_dir',
+        metavar='SALT_PILLAR_ROOTS', default='',
+        help="Assign SALT_PILLAR_ROOTS to salt minion, path as string")
+    
+    parser.add_option(
+        '--hostname', dest='hostname',
+        metavar='HOSTNAME', default='',
+        help="Assign HOSTNAME to salt minion")
+    parser.add_option(
+        '-n', '--count', dest='count', type='int',
+        metavar='COUNT', default=None,
+        help="Launch a fleet of COUNT minions, expanding HOSTNAME "
+             "as a pattern, e.g. web{0:02d}")
+    parser.add_option(
+        '--domain', dest='domain',
+        metavar='DOMAIN', default='',
+        help="Assign DOMAIN name to salt minion")
+    parser.add_option(
+        '--ip_address', dest='ip_address',
+        metavar='IP_ADDRESS', default='',
+        help="Assign elastic IP address to salt minion, "
+             "comma separated list for a fleet")
+    parser.add_option(
+        '--preseed', dest='pre_seed',
+        action='store_true', default=False,
+        help="Pre-seed the minion keys")
+    parser.add_option(
+        '--save-keys', dest='save_keys',
+        action='store_true', default=False,
+        help="Save keys locally, including the pre-seeded private key")
+    parser.add_option(
+        '--minion-pki-dir', dest='minion_pki_dir',
+        metavar='PKI_DIR', default=DEFAULT_MINION_PKI_DIR,
+        help="Minion PKI_DIR, when pre-seeding minion keys")
+    parser.add_option(
+        '--compress-user-data', dest='compress_user_data',
+        action='store_true', default=False,
+        help="Gzip the user data")
+    parser.add_option(
+        '-w', '--write-user-data', dest='write_user_data',
+        action='store_true', default=False,
+        help="Write user-data to USERDATA directory (~/.shaker/userdata)")
+    import shaker.log
+    parser.add_option('-l',
+            '--log-level',
+            dest='log_level',
+            default='info',
+            choices=shaker.log.LOG_LEVELS.keys(),
+            help='Log level: {0}.  \nDefault: %%default'.format(
+                 ', '.join(shaker.log.LOG_LEVELS.keys()))
+            )
+    parser.add_option(
+        '--use-daemon', dest='use_daemon',
+        action='store_true', default=False,
+        help="Submit the launch to a running daemon (see: shaker serve)")
+    parser.add_option(
+        '--refresh', dest='refresh_inventory',
+        action='store_true', default=False,
+        help="Ignore the cached EC2 inventory and query EC2 afresh")
+    parser.add_option(
+        '--manifest', dest='manifest',
+        metavar='MANIFEST',
+        help="Launch the profiles listed in the MANIFEST file concurrently")
+    parser.add_option(
+        '--concurrency', dest='concurrency', type='int',
+        metavar='N', default=shaker.manifest.DEFAULT_CONCURRENCY,
+        help="Launch at most N manifest profiles at once.  Default: %default")
+    parser.add_option(
+        '--stats', dest='show_stats',
+        action='store_true', default=False,
+        help="Print the count, response size and latency of EC2 calls")
+    parser.add_option(
+        '--trace', dest='trace_file', metavar='FILE',
+        help="Write a trace of the launch phases and EC2 calls to FILE "
+             "(Chrome trace-event JSON) and print a summary")
+    argv = sys.argv[1:] if args is None else args
+    (opts, args) = parser.parse_args(argv)
+    if cwd:
+        resolve_paths(opts, cwd)
+    if len(args) < 1:
+        if opts.ec2_ami_id or opts.release or opts.manifest:
+            profile = None
         else:
-            opts.distro = opts.release
-        LOG.info("shaker invoked with args: {0}".format(', '.join(sys.argv[1:])))
-        return opts, config_dir, profile
+            print parser.format_help().strip()
+            errmsg = "\nError: Specify shaker profile or EC2 ami or Ubuntu release"
+            raise SystemExit(errmsg)
+    else:
+        profile = args[0]
+    import shaker.config
+    config_dir = shaker.config.get_config_dir(opts.config_dir)
+    shaker.log.start_logger(
+        __name__,
+        os.path.join(config_dir, 'shaker.log'),
+        opts.log_level)
+    if opts.ec2_ami_id:
+        opts.distro = ''  # mutually exclusive
+    else:
+        opts.distro = opts.release
+    LOG.info("shaker invoked with args: {0}".format(', '.join(argv)))
+    return opts, config_dir, profile
@@ -15,31 +15,182 @@ Select the AMI from specified distro
 >>> profile['ec2_architecture'] = 'x86_64'
 >>> get_ami(profile, release)
 'ami-bb88acfe'
+
+The catalog is parsed once per process into a flat index keyed by
+(distro, release, region, architecture).  Given a config directory,
+the index is also cached on disk and rebuilt only when the catalog
+changes: the built-in catalog's in ``ami-index.json``, the synced
+catalog's in ``ami-catalog-index.json``.
+
+The catalog written by shaker-ami-sync (``ami-catalog.json`` in the
+config directory) takes precedence over the built-in EBSImages, which
+still serve releases it lacks.  Its paravirtual images on standard
+EBS volumes are preferred, as in the built-in catalog, then those on
+SSD and provisioned IOPS volumes (see image_rank).
 """
 
-import yaml
+import os
+import json
+import hashlib
+import threading
 
+import shaker.fileutil
 import shaker.log
 LOG = shaker.log.getLogger(__name__)
 
 DEFAULT_RELEASE = 'precise'
+INDEX_FILE = 'ami-index.json'
+CATALOG_FILE = 'ami-catalog.json'
+CATALOG_INDEX_FILE = 'ami-catalog-index.json'
+INDEX_VERSION = 2
+
+# EBS root stores of the synced catalog, in order of preference:
+# standard (magnetic) volumes, as the built-in catalog, then general
+# purpose SSD (gp2) and provisioned IOPS (io1) volumes, named as in
+# simplestreams and on the release pages.
+ROOT_STORES = ['ebs', 'ssd', 'ebs-ssd', 'io1', 'ebs-io1']
+VIRTUALIZATION_TYPES = ['paravirtual', 'hvm']
+
+_index = {}
+_digests = {}
+_index_lock = threading.Lock()
+
+
+def catalog_digest(catalog):
+    """Identify a catalog and the way it is indexed, so cached indexes
+    are rebuilt when either changes.
+    """
+    return '{0}-{1}'.format(INDEX_VERSION, hashlib.sha1(catalog).hexdigest())
+
+
+def index_key(distro, release, region, architecture):
+    return '/'.join([distro, release, region, architecture])
+
+
+def image_rank(root_store, virt):
+    """Return the sort key preferring an image: paravirtual over hvm,
+    as the built-in catalog, then by root store, any unknown EBS store
+    last.
+    """
+    store = ROOT_STORES.index(root_store) if root_store in ROOT_STORES \
+        else len(ROOT_STORES)
+    return (VIRTUALIZATION_TYPES.index(virt) if virt in VIRTUALIZATION_TYPES
+            else len(VIRTUALIZATION_TYPES), store)
+
+
+def build_synced_index(catalog):
+    """Index a catalog written by shaker-ami-sync, whose images are
+    keyed by distro/release/region/architecture/root store/virtualization.
+    Instance-store images are left out, shaker launches EBS images.
+    """
+    c = json.loads(catalog)
+    amis = {}
+    ranks = {}
+    for key, ami in sorted(c['images'].items()):
+        distro, release, region, architecture, root_store, virt = key.split('/')
+        if root_store == 'instance-store':
+            continue
+        k = index_key(distro, release, region, architecture)
+        rank = image_rank(root_store, virt)
+        if k not in amis or rank < ranks[k]:
+            amis[k] = ami
+            ranks[k] = rank
+    return {'distros': c['distros'], 'amis': amis}
 
-def get_ami(profile, release=None):
+
+def build_index(catalog):
+    """Parse a catalog into {'distros': [...], 'amis': {key: ami}},
+    keyed by index_key().
+    """
+    if catalog.lstrip().startswith('{'):
+        return build_synced_index(catalog)
+    import yaml
+    y = yaml.safe_load(catalog)
+    amis = {}
+    for distro in y['release']:
+        for release, regions in (y.get(distro) or {}).items():
+            for region, architectures in regions.items():
+                for architecture, ami in architectures.items():
+                    amis[index_key(distro, release, region, architecture)] = ami
+    return {'distros': list(y['release']), 'amis': amis}
+
+
+def load_index(path, digest):
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not index.get('digest') == digest:
+        return None
+    return index
+
+
+def save_index(path, index):
+    shaker.fileutil.atomic_write(path, json.dumps(index, separators=(',', ':')))
+
+
+def read_catalog(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def get_index(config_dir=None, catalog=None):
+    """Return the AMI index for the catalog, memoized in-process
+    and, given a config directory, cached on disk.
+    """
+    catalog_path = config_dir and os.path.join(config_dir, CATALOG_FILE)
+    index_file = INDEX_FILE
+    if not catalog and catalog_path and os.path.isfile(catalog_path):
+        # Identify the synced catalog by its stat, to avoid reading
+        # and hashing it on every lookup.
+        st = os.stat(catalog_path)
+        source = (catalog_path, st.st_mtime, st.st_size)
+        index_file = CATALOG_INDEX_FILE
+    else:
+        catalog = source = catalog or EBSImages
+    digest = _digests.get(source)
+    if not digest:
+        if not catalog:
+            catalog = read_catalog(catalog_path)
+        digest = _digests[source] = catalog_digest(catalog)
+    with _index_lock:
+        if digest not in _index:
+            path = config_dir and os.path.join(config_dir, index_file)
+            index = path and load_index(path, digest)
+            if not index:
+                if not catalog:
+                    catalog = read_catalog(catalog_path)
+                index = build_index(catalog)
+                index['digest'] = digest
+                if path:
+                    save_index(path, index)
+            _index[digest] = index
+        return _index[digest]
+
+
+def get_ami(profile, release=None, config_dir=None):
     """Return an AMI ID matching the distro.
     """
-    y = yaml.load(EBSImages)
+    indexes = [get_index(config_dir)]
+    builtin = get_index(config_dir, EBSImages)
+    if builtin is not indexes[0]:
+        indexes.append(builtin)
     if not release:
         release = profile.get('ubuntu_release') or DEFAULT_RELEASE
-    try:
+    if profile.get('ec2_zone'):
         region = profile['ec2_zone'][:-1]
-        architecture = profile.get('ec2_architecture', 'i386')
-        for distro in y['release']:
-            if release in y[distro]:
-                return y[distro][release][region][architecture]
-    except KeyError:
-        pass
-    except IndexError:
-        pass
+    else:
+        region = profile.get('ec2_region')
+    if not region:
+        return None
+    architecture = profile.get('ec2_architecture', 'i386')
+    for index in indexes:
+        for distro in index['distros']:
+            ami = index['amis'].get(
+                index_key(distro, release, region, architecture))
+            if ami:
+                return ami
     return None
 
 # EBSImages to be treated as (and eventually packaged) a yaml file.
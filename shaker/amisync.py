@@ -0,0 +1,238 @@
+"""
+Build the AMI catalog from saved Ubuntu cloud image listings.
+
+Two listing formats are understood:
+
+* the HTML release pages, e.g.
+  http://cloud-images.ubuntu.com/releases/precise/release/
+* simplestreams JSON, e.g.
+  http://cloud-images.ubuntu.com/releases/streams/v1/com.ubuntu.cloud:released:aws.json
+
+Images are merged into the catalog, ``config_dir/ami-catalog.json``,
+keyed by distro, release, region, architecture, root store and
+virtualization type.  Each sync bumps the catalog version.
+shaker.ami.get_ami() reads this catalog when it exists, falling back
+to the built-in one.
+
+$ UDISTRO=precise; curl -o $UDISTRO.html http://cloud-images.ubuntu.com/releases/$UDISTRO/release/
+$ shaker-ami-sync --release $UDISTRO $UDISTRO.html
+"""
+import os
+import re
+import json
+import time
+import optparse
+from HTMLParser import HTMLParser
+
+import shaker.ami
+import shaker.config
+import shaker.fileutil
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+ARCHITECTURES = {
+    '32-bit': 'i386',
+    'i386': 'i386',
+    '64-bit': 'x86_64',
+    'amd64': 'x86_64',
+    'x86_64': 'x86_64',
+}
+VIRTUALIZATION_TYPES = {
+    'pv': 'paravirtual',
+    'paravirtual': 'paravirtual',
+    'hvm': 'hvm',
+}
+AMI_ID = re.compile(r'ami-[0-9a-f]+')
+
+
+def image_key(image):
+    return '/'.join([
+        image['distro'],
+        image['release'],
+        image['region'],
+        image['architecture'],
+        image['root_store'],
+        image['virtualization_type'],
+    ])
+
+
+def make_image(distro, release, region, arch, root_store, virt, ami):
+    """Return a normalized image dict, or None if it isn't usable.
+    """
+    match = AMI_ID.search(ami or '')
+    architecture = ARCHITECTURES.get((arch or '').strip().lower())
+    if not (match and architecture and region and release):
+        return None
+    return {
+        'distro': distro,
+        'release': release,
+        'region': region.strip(),
+        'architecture': architecture,
+        'root_store': (root_store or 'ebs').strip().lower(),
+        'virtualization_type': VIRTUALIZATION_TYPES.get(
+            (virt or 'pv').strip().lower(), 'paravirtual'),
+        'id': match.group(0),
+    }
+
+
+class TableParser(HTMLParser):
+    """Collect the rows of HTML tables as lists of cell text.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.rows = []
+        self.row = None
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.row = []
+        elif tag in ('td', 'th') and self.row is not None:
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if tag in ('td', 'th') and self.cell is not None:
+            self.row.append(''.join(self.cell).strip())
+            self.cell = None
+        elif tag == 'tr' and self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def parse_html(stream, release, distro='ubuntu'):
+    """Yield the images of an HTML release page, parsing the page
+    incrementally as it's read.
+    """
+    parser = TableParser()
+    headings = None
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        rows, parser.rows = parser.rows, []
+        for row in rows:
+            if headings is None:
+                headings = [h.lower() for h in row]
+                continue
+            cells = dict(zip(headings, row))
+            image = make_image(
+                distro,
+                release,
+                cells.get('region') or cells.get('zone'),
+                cells.get('arch'),
+                cells.get('root store') or cells.get('instance type'),
+                cells.get('virtualization') or cells.get('virtualization type'),
+                cells.get('ami') or cells.get('ami-id'))
+            if image:
+                yield image
+        if not chunk:
+            break
+
+
+def parse_simplestreams(stream, distro='ubuntu'):
+    """Yield the images of the latest version of each product in a
+    simplestreams JSON listing.
+    """
+    # The standard library has no incremental JSON parser; the
+    # products are walked one at a time once loaded.
+    data = json.load(stream)
+    for product in data.get('products', {}).values():
+        versions = product.get('versions', {})
+        if not versions:
+            continue
+        latest = versions[max(versions)]
+        for item in latest.get('items', {}).values():
+            image = make_image(
+                distro,
+                product.get('release'),
+                item.get('crsn'),
+                product.get('arch'),
+                item.get('root_store'),
+                item.get('virt'),
+                item.get('id'))
+            if image:
+                yield image
+
+
+def load_catalog(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'version': 0, 'distros': [], 'images': {}}
+
+
+def save_catalog(path, catalog):
+    shaker.fileutil.atomic_write(
+        path, json.dumps(catalog, indent=1, sort_keys=True))
+
+
+def merge(catalog, images):
+    """Merge images into the catalog, returning the number of
+    entries added or changed.
+    """
+    changed = 0
+    for image in images:
+        if image['distro'] not in catalog['distros']:
+            catalog['distros'].append(image['distro'])
+        key = image_key(image)
+        if not catalog['images'].get(key) == image['id']:
+            catalog['images'][key] = image['id']
+            changed += 1
+    return changed
+
+
+def sniff(path):
+    """Return 'json' or 'html', judging by the file's first byte.
+    """
+    with open(path, 'r') as f:
+        head = f.read(512).lstrip()
+    return 'json' if head.startswith('{') else 'html'
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%prog [options] listing [listing ...]")
+    parser.add_option(
+        '--config-dir', dest='config_dir',
+        help="Configuration directory")
+    parser.add_option(
+        '--release', dest='release',
+        help="Release of HTML listings.  Default: the listing's file name")
+    parser.add_option(
+        '--distro', dest='distro', default='ubuntu',
+        help="Distro of the listings.  Default: %default")
+    opts, args = parser.parse_args(args)
+    if not args:
+        parser.error("specify one or more listing files")
+    config_dir = shaker.config.get_config_dir(opts.config_dir)
+    path = os.path.join(config_dir, shaker.ami.CATALOG_FILE)
+    catalog = load_catalog(path)
+    changed = 0
+    for listing in args:
+        with open(listing, 'r') as stream:
+            if sniff(listing) == 'json':
+                images = parse_simplestreams(stream, opts.distro)
+            else:
+                release = opts.release or \
+                    os.path.splitext(os.path.basename(listing))[0]
+                images = parse_html(stream, release, opts.distro)
+            changed += merge(catalog, images)
+    if changed:
+        catalog['version'] = catalog.get('version', 0) + 1
+        catalog['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        save_catalog(path, catalog)
+    print "{0}: version {1}, {2} images, {3} changed".format(
+        path, catalog.get('version', 0), len(catalog['images']), changed)
+
+
+if __name__ == '__main__':
+    main()
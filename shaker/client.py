@@ -0,0 +1,36 @@
+"""
+Thin client submitting jobs to a running ``shaker serve`` daemon.
+"""
+import sys
+import json
+import socket
+
+
+def submit(path, request, out=sys.stdout, err=sys.stderr):
+    """Send a job to the daemon listening on ``path``, relaying its
+    progress as it arrives.  Return True if the job succeeded.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        print >>err, "Unable to reach shaker daemon at {0}: {1}".format(
+            path, e)
+        return False
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        for line in sock.makefile('r'):
+            event = json.loads(line)
+            if event['event'] == 'output':
+                out.write(event['text'])
+                out.flush()
+            elif event['event'] == 'log':
+                if event['level'] in ('WARNING', 'ERROR', 'CRITICAL'):
+                    print >>err, "{0}: {1}".format(
+                        event['level'], event['message'])
+            elif event['event'] == 'done':
+                return event['ok']
+    finally:
+        sock.close()
+    print >>err, "shaker daemon closed the connection"
+    return False
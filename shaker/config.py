@@ -4,16 +4,23 @@ import os
 Shaker configuration
 """
 
-from jinja2 import Template
-import yaml
+import copy
+import cPickle as pickle
 import shaker.ami
+import shaker.fileutil
 import shaker.log
+from shaker.version import __version__
 LOG = shaker.log.getLogger(__name__)
 
+# Merged profiles are cached in the profile directory, keyed by the
+# mtime and size of the profile files, so warm starts skip parsing.
+PROFILE_CACHE = '.cache'
+
 DEFAULTS = {
     # These values will be overridden in profile/default or
     # a user profile, or command-line options.
     'hostname': None,
+    'count': 1,
     'domain': None,
     'sudouser': None,
     'ssh_port': '22',
@@ -35,6 +42,11 @@ DEFAULTS = {
     'ec2_root_device': '/dev/sda1',
     'ec2_architecture': 'i386',
     'ec2_placement_group': None,
+    'run_instance_timeout': 180,
+    'ec2_request_rate': 10,
+    'ec2_max_retries': 5,
+    'inventory_ttl': 300,
+    'metadata_ttl': 86400,
     'salt_master': None,
     'salt_id': None,
     'salt_grains': [],
@@ -44,12 +56,21 @@ DEFAULTS = {
     'boothook_template': None,
     'minion_template': None,
     'pre_seed': False,
+    'keypool_size': 0,
+    'key_size': 2048,
+    'key_backend': None,
+    'compress_user_data': False,
     'ip_address': None,
     'check_name_before_create': False,
     'check_name_after_create': True,
     'additional_tags': {},
     }
 
+# Parsed profiles, keyed by path and validated against the file's
+# mtime and size, so a long-running process parses each profile once.
+_profiles = {}
+_merged_profiles = {}
+
 
 def get_config_dir(path=None):
     """
@@ -62,37 +83,112 @@ def get_config_dir(path=None):
         config_dir = os.environ['SHAKER_CONFIG_DIR']
     else:
         config_dir = os.path.expanduser("~/.shaker")
-    if not os.path.isdir(config_dir):
-        os.makedirs(config_dir)
-    return config_dir
+    return shaker.fileutil.make_dir(config_dir)
 
 
 def get_pki_dir(config_dir):
-    pki_dir = os.path.join(config_dir, 'pki')
-    if not os.path.isdir(pki_dir):
-        os.makedirs(pki_dir)
-    return pki_dir
+    return shaker.fileutil.make_dir(os.path.join(config_dir, 'pki'))
 
 
 def get_userdata_dir(config_dir):
-    userdata_dir = os.path.join(config_dir, 'userdata')
-    if not os.path.isdir(userdata_dir):
-        os.makedirs(userdata_dir)
-    return userdata_dir
+    return shaker.fileutil.make_dir(os.path.join(config_dir, 'userdata'))
+
+
+def yaml_loader():
+    """Return the loader for profiles, which are plain data: the
+    safe loader, using libyaml when PyYAML was built with it.
+    """
+    import yaml
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+
+def load_profile_file(path):
+    """Return the parsed contents of a profile file.
+    """
+    stamp = file_stamp(path)
+    cached = _profiles.get(path)
+    if not cached or cached[0] != stamp:
+        import yaml
+        with open(path, 'r') as f:
+            cached = _profiles[path] = (
+                stamp, yaml.load(f, Loader=yaml_loader()) or {})
+    return copy.deepcopy(cached[1])
+
+
+def read_profile_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # A missing, partial or incompatible cache is rebuilt.
+        return {}
+
+
+def write_profile_cache(path, name, stamps, profile):
+    """Store a merged profile, keeping the other cached profiles.
+    """
+    cache = read_profile_cache(path)
+    cache[name] = (stamps, profile)
+    # Profiles may hold AWS credentials.
+    shaker.fileutil.atomic_write(
+        path, pickle.dumps(cache, pickle.HIGHEST_PROTOCOL), 0600)
+
+
+def merged_profile(config_dir, profile_name=None):
+    """Return DEFAULTS updated with the default profile and the
+    named profile, if any.  The result is cached, in-process and on
+    disk, until a profile file changes.
+    """
+    default_profile(config_dir, load=False)
+    profile_dir = os.path.join(config_dir, 'profile')
+    paths = [os.path.join(profile_dir, 'default')]
+    if profile_name:
+        paths.append(os.path.join(profile_dir, profile_name))
+    stamps = (__version__,) + tuple(file_stamp(p) for p in paths)
+    key = (config_dir, profile_name)
+    cached = _merged_profiles.get(key)
+    cache_path = os.path.join(profile_dir, PROFILE_CACHE)
+    if not cached or cached[0] != stamps:
+        cached = read_profile_cache(cache_path).get(profile_name)
+    if not cached or cached[0] != stamps:
+        import yaml
+        profile = dict(DEFAULTS)
+        profile.update(load_profile_file(paths[0]))
+        cacheable = True
+        if profile_name:
+            try:
+                profile.update(load_profile_file(paths[1]))
+            except yaml.YAMLError, err:
+                msg = "Error scanning profile {0}: {1}".format(
+                    paths[1], err)
+                LOG.error(msg)
+                cacheable = False
+        cached = (stamps, profile)
+        if cacheable:
+            write_profile_cache(cache_path, profile_name, stamps, profile)
+    _merged_profiles[key] = cached
+    return copy.deepcopy(cached[1])
 
 
-def default_profile(config_dir):
+def default_profile(config_dir, load=True):
     profile_dir = os.path.join(config_dir, 'profile')
     default_profile = os.path.join(profile_dir, 'default')
-    if not os.path.isdir(profile_dir):
-        os.makedirs(profile_dir)
+    shaker.fileutil.make_dir(profile_dir)
     if not os.path.isfile(default_profile):
         LOG.info("Default profile not found, creating: {0}".format(default_profile))
+        from jinja2 import Template
         template = Template(DEFAULT_PROFILE)
         with open(default_profile, 'w') as f:
             f.write(template.render(DEFAULTS))
+    if not load:
+        return None
     profile = dict(DEFAULTS)
-    profile.update(yaml.load(file(default_profile, 'r')) or {})
+    profile.update(load_profile_file(default_profile))
     return profile
 
 
@@ -105,6 +201,7 @@ def create_profile(profile, config_dir, profile_name):
     """
     profile_dir = os.path.join(config_dir, 'profile')
     profile_path = os.path.join(profile_dir, profile_name)
+    import yaml
     profile_copy = dict(profile)
     if not os.path.isfile(profile_path):
         msg = "Creating new profile: {0}".format(profile_path)
@@ -117,10 +214,11 @@ def create_profile(profile, config_dir, profile_name):
     return profile_copy
 
 
-def user_profile(cli, config_dir, profile_name=None):
-    """User profile, cli overrides defaults.
+def user_profile(cli, config_dir, profile_name=None, overrides=None):
+    """User profile, cli overrides defaults.  Overrides (e.g. from a
+    manifest entry) are applied on top of the named profile.
     """
-    profile = default_profile(config_dir) or {}
+    default_profile(config_dir, load=False)
     if profile_name:
         profile_dir = os.path.join(config_dir, 'profile')
         profile_path = os.path.join(profile_dir, profile_name)
@@ -129,29 +227,26 @@ def user_profile(cli, config_dir, profile_name=None):
             import shutil
             shutil.copy2(default_path, profile_path)
             LOG.info("Created profile: {0}".format(profile_path))
-        else:
-            try:
-                profile.update(yaml.load(file(profile_path, 'r')) or {})
-            except yaml.scanner.ScannerError, err:
-                msg = "Error scanning profile {0}: {1}".format(
-                    profile_path, err)
-                LOG.error(msg)
     else:
         LOG.info("No profile specified.")
+    profile = merged_profile(config_dir, profile_name)
+    if overrides:
+        profile.update(overrides)
     for k, v in cli.__dict__.items():
         if k in profile and v:
             profile[k] = v
     # If the distro is specified in the command-line, we override
     # the profile ec2_ami_id value.
     if cli.distro:
-        ec2_ami_id = shaker.ami.get_ami(profile, cli.distro)
+        ec2_ami_id = shaker.ami.get_ami(profile, cli.distro, config_dir)
         if ec2_ami_id:
             profile['ec2_ami_id'] = ec2_ami_id
         else:
             msg = "Unable to find AMI for distro: {0}".format(cli.distro)
             LOG.info(msg)
     if not profile['ec2_ami_id'] and profile['ubuntu_release']:
-        profile['ec2_ami_id'] = shaker.ami.get_ami(profile['ubuntu_release'], profile)
+        profile['ec2_ami_id'] = shaker.ami.get_ami(
+            profile, profile['ubuntu_release'], config_dir)
     msg = "Selected AMI {0} in zone {1}".format(
         profile['ec2_ami_id'],
         profile['ec2_zone'])
@@ -179,6 +274,15 @@ DEFAULT_PROFILE = """###########################################################
 #hostname:
 #domain:
 
+####################################################################
+# count: number of minions to launch.  With a count greater than
+# one, hostname and salt_id are patterns expanded with the 1-based
+# index of each host, e.g. web{0:02d}; the index is appended if the
+# pattern has no format field.
+####################################################################
+
+#count: 1
+
 ####################################################################
 # salt_master is the location (dns or ip) of the salt master
 # to connect to, e.g.: master.example.com
@@ -214,6 +318,32 @@ DEFAULT_PROFILE = """###########################################################
 
 #pre_seed: False
 
+####################################################################
+# keypool_size: when pre-seeding, claim minion keys from a pool of
+# pre-generated keys (~/.shaker/pki/pool), refilled in the background
+# to this size.  Fill it ahead of time with: shaker keypool fill N
+# Default is 0 (generate keys during the launch).
+####################################################################
+
+#keypool_size: 0
+
+####################################################################
+# key_size: size in bits of pre-seeded minion keys.  Default 2048.
+# key_backend: library generating the keys, m2crypto or
+# cryptography.  Default is the first one installed.
+####################################################################
+
+#key_size: 2048
+#key_backend: m2crypto
+
+####################################################################
+# compress_user_data: gzip the user data, which cloud-init accepts,
+# to stay under the EC2 limit of 16KB (e.g. with pre-seeded keys and
+# many grains).  Default is false.
+####################################################################
+
+#compress_user_data: False
+
 ####################################################################
 # Assign elastic ip address to minion after the instance is
 # launched.  If the ip address is already in use, the
@@ -362,4 +492,37 @@ DEFAULT_PROFILE = """###########################################################
 ####################################################################
 
 #ec2_root_device: /dev/sda1
+
+####################################################################
+# run_instance_timeout: seconds to wait for launched instances to
+# reach the running state.
+####################################################################
+
+#run_instance_timeout: 180
+
+####################################################################
+# ec2_request_rate: EC2 API requests per second per region, shared
+# by concurrent launches.  0 disables the limit.
+# ec2_max_retries: retries of throttled or transiently failing EC2
+# calls, with exponential backoff.
+####################################################################
+
+#ec2_request_rate: 10
+#ec2_max_retries: 5
+
+####################################################################
+# inventory_ttl: seconds for which EC2 lookups of Name tags and
+# elastic ip addresses cached under the config directory are
+# trusted.  Set to 0 to disable the cache; --refresh ignores it
+# for a single run.
+####################################################################
+
+#inventory_ttl: 300
+
+####################################################################
+# metadata_ttl: seconds for which cached image attributes and key
+# pairs, which rarely change, are trusted.
+####################################################################
+
+#metadata_ttl: 86400
 """
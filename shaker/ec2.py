@@ -0,0 +1,225 @@
+"""
+EC2 client layer shared by every shaker code path.
+
+Connections made through connect() send their API calls through a
+per-region token bucket, so concurrent launches (threads, manifest
+profiles, the daemon) stay under a configurable request rate.  Calls
+which EC2 throttles, or which fail transiently, are retried with
+exponential backoff and full jitter instead of failing the launch::
+
+    conn = shaker.ec2.connect('us-east-1', rate=10, max_retries=5)
+
+Throttling responses are always safe to retry.  Server and network
+errors are only retried for idempotent calls: lookups, tagging,
+termination and calls carrying a ClientToken (see launch_instances).
+The throttles and retries of each region are counted by its Limiter.
+"""
+import re
+import sys
+import time
+import random
+import threading
+
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+DEFAULT_RATE = 10  # requests per second per region
+DEFAULT_MAX_RETRIES = 5
+BASE_DELAY = 0.5  # seconds
+MAX_DELAY = 20.0  # seconds
+
+THROTTLING_CODES = [
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+]
+TRANSIENT_CODES = [
+    'InternalError',
+    'ServiceUnavailable',
+    'Unavailable',
+]
+TRANSIENT_STATUS = [500, 502, 503, 504]
+IDEMPOTENT_ACTIONS = [
+    'CreateTags',
+    'DeleteTags',
+    'TerminateInstances',
+]
+ERROR_CODE = re.compile(r'<Code>([^<]+)</Code>')
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def backoff(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    """Return the delay before the given retry: exponential, capped,
+    with full jitter so throttled threads don't retry in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_idempotent(action, params):
+    return (action.startswith('Describe') or
+            action in IDEMPOTENT_ACTIONS or
+            'ClientToken' in (params or {}))
+
+
+class TokenBucket(object):
+    """Allow rate requests per second on average, in bursts of at
+    most capacity.  A rate of 0 disables the limit.
+    """
+    def __init__(self, rate, capacity=None):
+        self.lock = threading.Lock()
+        self.configure(rate, capacity)
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def configure(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+
+    def acquire(self):
+        """Take a token, sleeping until one is available.
+        """
+        while self.rate:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        """Empty the bucket, slowing every thread after a throttle.
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+
+
+class Limiter(object):
+    """Rate limit and retry state of one region.
+    """
+    def __init__(self, region, rate=DEFAULT_RATE,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.region = region
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.throttled = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def count(self, throttled):
+        with self.lock:
+            self.retried += 1
+            if throttled:
+                self.throttled += 1
+
+    def call(self, make_request, http_exceptions, action, *args, **kwargs):
+        """Send a request, retrying throttling and transient errors.
+        """
+        import boto.exception
+        params = args[0] if args else kwargs.get('params')
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            response = None
+            try:
+                response = make_request(action, *args, **kwargs)
+                code = None
+                if response.status >= 400:
+                    match = ERROR_CODE.search(response.read() or '')
+                    code = match and match.group(1)
+                if code not in THROTTLING_CODES:
+                    return response
+                error = "{0} {1}".format(response.status, code)
+            except boto.exception.BotoServerError, err:
+                # Raised by boto for 5xx responses.
+                code = err.error_code
+                if (code not in THROTTLING_CODES and
+                    (err.status not in TRANSIENT_STATUS and
+                     code not in TRANSIENT_CODES or
+                     not is_idempotent(action, params))):
+                    raise
+                error = "{0} {1}".format(err.status, code or err.reason)
+                exc_info = sys.exc_info()
+            except http_exceptions, err:
+                code = None
+                if not is_idempotent(action, params):
+                    raise
+                error = str(err) or err.__class__.__name__
+                exc_info = sys.exc_info()
+            if attempt >= self.max_retries:
+                LOG.error("{0} in {1} failed after {2} retries: {3}".format(
+                    action, self.region, attempt, error))
+                if response is not None:
+                    # boto raises the error from the response.
+                    return response
+                raise exc_info[0], exc_info[1], exc_info[2]
+            throttled = code in THROTTLING_CODES
+            if throttled:
+                self.bucket.drain()
+            self.count(throttled)
+            delay = backoff(attempt)
+            LOG.info("{0} in {1}: {2}, retrying in {3:.1f}s".format(
+                action, self.region, error, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def format_summary(self):
+        return "{0}: {1} throttled, {2} retried".format(
+            self.region, self.throttled, self.retried)
+
+
+def get_limiter(region, rate=DEFAULT_RATE, max_retries=DEFAULT_MAX_RETRIES):
+    """Return the region's Limiter, shared by all its connections and
+    updated with the given settings.
+    """
+    with _lock:
+        limiter = _limiters.get(region)
+        if limiter is None:
+            limiter = _limiters[region] = Limiter(region, rate, max_retries)
+        else:
+            limiter.bucket.configure(rate)
+            limiter.max_retries = max_retries
+        return limiter
+
+
+def limiters():
+    with _lock:
+        return [_limiters[r] for r in sorted(_limiters)]
+
+
+def install(conn, region, rate=DEFAULT_RATE, max_retries=DEFAULT_MAX_RETRIES):
+    """Route the connection's API calls through the region's Limiter,
+    returning it.  A connection is only installed once.
+    """
+    limiter = getattr(conn, 'shaker_limiter', None)
+    if limiter:
+        return limiter
+    limiter = conn.shaker_limiter = get_limiter(region, rate, max_retries)
+    # Retries are the Limiter's: boto would otherwise retry every 5xx,
+    # including non-idempotent calls, without regard to the rate.
+    conn.num_retries = 0
+    make_request = conn.make_request
+    http_exceptions = conn.http_exceptions
+
+    def limited(action, *args, **kwargs):
+        return limiter.call(
+            make_request, http_exceptions, action, *args, **kwargs)
+    conn.make_request = limited
+    return limiter
+
+
+def connect(region, rate=DEFAULT_RATE, max_retries=DEFAULT_MAX_RETRIES,
+            **params):
+    """Connect to the region, returning None for an unknown region.
+    """
+    import boto.ec2
+    conn = boto.ec2.connect_to_region(region, **params)
+    if conn:
+        install(conn, region, rate, max_retries)
+    return conn
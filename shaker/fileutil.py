@@ -0,0 +1,59 @@
+"""
+File helpers safe for concurrent shaker processes (manifest
+launches, the daemon, background key pool refills) sharing the
+config directory.
+"""
+import os
+import fcntl
+import tempfile
+import contextlib
+
+# The mode open() would create files with.
+_umask = os.umask(0)
+os.umask(_umask)
+DEFAULT_MODE = 0666 & ~_umask
+
+
+def make_dir(path, mode=0777):
+    """Create a directory unless it exists, tolerating concurrent
+    launches creating it too.  Return the path.
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, mode)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+def atomic_write(path, data, mode=DEFAULT_MODE):
+    """Write data to a temporary file next to path and rename it
+    into place, so readers never see a partially written file.  The
+    file gets the given mode, by default that of a file made with
+    open().
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on path + '.lock', serializing threads
+    and processes updating path.  The lock file outlives the rename
+    of atomic_write, which path itself would not.
+    """
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
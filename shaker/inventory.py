@@ -0,0 +1,127 @@
+"""
+On-disk cache of what shaker knows about an EC2 region.
+
+Each region has a JSON file under ``config_dir/inventory`` holding
+sections of facts: instances, Name tags, elastic ip addresses, key
+pairs and images.  Every fact is stored with the time it was learned
+and is served only while younger than the TTL.  Shaker records the
+results of its own lookups, launches and terminations, so repeated
+checks within the TTL need no EC2 requests.
+
+Image attributes and key pairs rarely change, so they are trusted for
+the (much longer) metadata TTL.
+
+Facts are ``[value, timestamp]`` pairs; a timestamp of zero marks
+an invalidated fact.
+"""
+import os
+import json
+import time
+
+import shaker.fileutil
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+DEFAULT_TTL = 300  # seconds
+DEFAULT_METADATA_TTL = 86400  # seconds
+SECTIONS = ['instances', 'names', 'addresses', 'key_pairs', 'images']
+METADATA_SECTIONS = ['key_pairs', 'images']
+
+
+def get_inventory_dir(config_dir):
+    return shaker.fileutil.make_dir(os.path.join(config_dir, 'inventory'))
+
+
+class Inventory(object):
+    def __init__(self, config_dir, region, ttl=DEFAULT_TTL,
+                 metadata_ttl=DEFAULT_METADATA_TTL, offline=False):
+        """With offline set (e.g. for --dry-run), expired facts are
+        still served: a stale answer beats a network round trip.  A
+        ttl of zero disables the corresponding sections.
+        """
+        self.path = os.path.join(
+            get_inventory_dir(config_dir), '{0}.json'.format(region))
+        self.region = region
+        self.ttl = ttl
+        self.metadata_ttl = metadata_ttl
+        self.offline = offline
+        self.data = self.load()
+        self.dirty = set()
+
+    def load(self):
+        data = dict((section, {}) for section in SECTIONS)
+        try:
+            with open(self.path, 'r') as f:
+                data.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return data
+
+    def lookup(self, section, key):
+        """Return (found, value) for a fact, found being False if
+        the fact is unknown or has expired.
+        """
+        ttl = self.metadata_ttl if section in METADATA_SECTIONS else self.ttl
+        fact = self.data[section].get(key)
+        if not ttl or not fact or not fact[1]:
+            return False, None
+        value, timestamp = fact
+        if self.offline or time.time() - timestamp < ttl:
+            return True, value
+        return False, None
+
+    def update(self, section, key, value):
+        self.data[section][key] = [value, time.time()]
+        self.dirty.add((section, key))
+
+    def invalidate(self, section=None, key=None):
+        """Expire one fact, a whole section, or (by default) the
+        whole region.
+        """
+        sections = [section] if section else SECTIONS
+        for s in sections:
+            keys = [key] if key else self.data[s].keys()
+            for k in keys:
+                if k in self.data[s]:
+                    self.data[s][k][1] = 0
+                    self.dirty.add((s, k))
+
+    def add_instance(self, instance):
+        """Record an instance launched (or seen) by shaker.
+        """
+        name = instance.tags.get('Name')
+        self.update('instances', instance.id, {
+            'state': instance.state,
+            'ip_address': instance.ip_address,
+            'name': name,
+        })
+        if name:
+            self.update('names', name, instance.id)
+        if instance.ip_address and instance.state == 'running':
+            self.update('addresses', instance.ip_address, instance.id)
+
+    def remove_instances(self, instance_ids):
+        """Record terminated instances, freeing their Name tags and
+        elastic ip addresses.
+        """
+        ids = set(instance_ids)
+        for section in ['names', 'addresses']:
+            for key, fact in self.data[section].items():
+                if fact[0] in ids:
+                    self.update(section, key, None)
+        for id in ids:
+            if id in self.data['instances']:
+                self.update('instances', id, None)
+
+    def save(self):
+        """Write the facts updated in this run, merging with any
+        written concurrently by other shaker processes.
+        """
+        if not self.dirty:
+            return
+        with shaker.fileutil.locked(self.path):
+            data = self.load()
+            for section, key in self.dirty:
+                data[section][key] = self.data[section][key]
+            shaker.fileutil.atomic_write(self.path, json.dumps(data))
+        self.dirty = set()
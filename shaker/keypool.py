@@ -0,0 +1,166 @@
+"""
+A pool of pre-generated minion key pairs.
+
+RSA key generation is slow, so when pre-seeding minions shaker can
+claim a key pair generated ahead of time from ``config_dir/pki/pool``
+instead of generating one on the launch path.  The pool is filled by
+``shaker keypool fill N``, and refilled in the background after keys
+are claimed.
+
+Each key pair is a single file holding the private and public PEM
+keys, named after the key size so keys of several sizes can share
+the pool.  Files are written under a temporary name and renamed into
+place, and claimed by renaming them out of the pool, so a key pair
+is never handed out twice or read half-written.
+"""
+import os
+import sys
+import time
+import errno
+import optparse
+import subprocess
+import tempfile
+
+import shaker.config
+import shaker.fileutil
+import shaker.keys
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+KEY_SUFFIX = '.key'
+FILL_LOCK = '.filling'
+FILL_LOCK_TIMEOUT = 600  # seconds
+
+
+def get_pool_dir(pki_dir):
+    return shaker.fileutil.make_dir(os.path.join(pki_dir, 'pool'), 0700)
+
+
+def pool_keys(pool_dir, bits=shaker.keys.KEY_SIZE):
+    prefix = '{0}-'.format(bits)
+    return [f for f in os.listdir(pool_dir)
+            if f.startswith(prefix) and f.endswith(KEY_SUFFIX)]
+
+
+def add_key_pair(pool_dir, bits, public_key, private_key):
+    fd, tmp_path = tempfile.mkstemp(dir=pool_dir, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(private_key)
+        f.write(public_key)
+    name = '{0}-{1}{2}'.format(
+        bits, os.path.basename(tmp_path)[len('.tmp'):], KEY_SUFFIX)
+    os.rename(tmp_path, os.path.join(pool_dir, name))
+
+
+def split_key_pair(data):
+    """Split a pool file into (public_key, private_key).
+    """
+    marker = '-----END RSA PRIVATE KEY-----\n'
+    index = data.index(marker) + len(marker)
+    return data[index:], data[:index]
+
+
+def claim(pki_dir, bits=shaker.keys.KEY_SIZE):
+    """Take a key pair of the given size from the pool, returning
+    (public_key, private_key), or None if the pool has none.
+    """
+    pool_dir = get_pool_dir(pki_dir)
+    for name in pool_keys(pool_dir, bits):
+        path = os.path.join(pool_dir, name)
+        claimed = os.path.join(
+            pool_dir, '.claimed-{0}-{1}'.format(os.getpid(), name))
+        try:
+            os.rename(path, claimed)
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                continue  # claimed by someone else
+            raise
+        with open(claimed, 'r') as f:
+            data = f.read()
+        os.unlink(claimed)
+        return split_key_pair(data)
+    return None
+
+
+def fill(pki_dir, size, bits=shaker.keys.KEY_SIZE, backend=None):
+    """Generate key pairs until the pool holds ``size`` of them.
+    Only one filler runs at a time.
+    """
+    pool_dir = get_pool_dir(pki_dir)
+    lock = os.path.join(pool_dir, FILL_LOCK)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError, err:
+        if not err.errno == errno.EEXIST:
+            raise
+        if time.time() - os.path.getmtime(lock) < FILL_LOCK_TIMEOUT:
+            LOG.info("key pool is already being filled")
+            return 0
+        # A stale lock left by a filler that died.
+        os.unlink(lock)
+        return fill(pki_dir, size, bits, backend)
+    os.close(fd)
+    added = 0
+    try:
+        missing = size - len(pool_keys(pool_dir, bits))
+        keys = shaker.keys.generate_key_pairs(
+            range(max(missing, 0)), bits, backend)
+        for key in keys.values():
+            add_key_pair(
+                pool_dir, bits, key['public_key'], key['private_key'])
+            added += 1
+    finally:
+        os.unlink(lock)
+    LOG.info("added {0} key pairs to {1}".format(added, pool_dir))
+    return added
+
+
+def refill_in_background(config_dir, size, bits=shaker.keys.KEY_SIZE,
+                         backend=None):
+    """Start a detached process refilling the pool to ``size``.
+    """
+    args = ['--config-dir', config_dir, '--key-size', str(bits)]
+    if backend:
+        args.extend(['--key-backend', backend])
+    devnull = open(os.devnull, 'w')
+    subprocess.Popen(
+        [sys.executable, '-m', 'shaker.keypool'] + args + ['fill', str(size)],
+        stdin=devnull, stdout=devnull, stderr=devnull,
+        close_fds=True)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%prog keypool [options] fill N | status")
+    parser.add_option(
+        '--config-dir', dest='config_dir',
+        help="Configuration directory")
+    parser.add_option(
+        '--key-size', dest='key_size', type='int',
+        default=shaker.keys.KEY_SIZE,
+        help="Size of the generated keys.  Default: %default")
+    parser.add_option(
+        '--key-backend', dest='key_backend',
+        help="Key generation backend: m2crypto or cryptography")
+    opts, args = parser.parse_args(args)
+    config_dir = shaker.config.get_config_dir(opts.config_dir)
+    shaker.log.start_logger(
+        'shaker',
+        os.path.join(config_dir, 'shaker.log'),
+        'info')
+    pki_dir = shaker.config.get_pki_dir(config_dir)
+    if args[:1] == ['fill'] and len(args) == 2 and args[1].isdigit():
+        try:
+            fill(pki_dir, int(args[1]), opts.key_size, opts.key_backend)
+        except ValueError, err:
+            parser.error(str(err))
+    elif args[:1] == ['status']:
+        print "{0} {1}-bit key pairs in pool".format(
+            len(pool_keys(get_pool_dir(pki_dir), opts.key_size)),
+            opts.key_size)
+    else:
+        parser.error("specify 'fill N' or 'status'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Generate salt minion key pairs.
+
+Key generation is delegated to a backend; M2Crypto and cryptography
+are supported, and either produces keys salt accepts: an unencrypted
+PKCS#1 ("RSA PRIVATE KEY") private key and a SubjectPublicKeyInfo
+("PUBLIC KEY") public key, both PEM encoded.  Use
+util/keygen_benchmark.py to compare the backends on a launch host.
+"""
+import os
+import sys
+import json
+
+KEY_SIZE = 2048
+PUBLIC_EXPONENT = 65537
+
+
+class KeyBackend(object):
+    name = None
+
+    @classmethod
+    def available(cls):
+        try:
+            cls.load()
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def load(cls):
+        """Import the backend's library, raising ImportError if it
+        isn't installed.
+        """
+        raise NotImplementedError
+
+    def generate_key_pair(self, bits=KEY_SIZE):
+        """Return a new RSA key pair as (public_key, private_key) PEM
+        strings.
+        """
+        raise NotImplementedError
+
+
+class M2CryptoBackend(KeyBackend):
+    name = 'm2crypto'
+
+    @classmethod
+    def load(cls):
+        import M2Crypto
+        return M2Crypto
+
+    def generate_key_pair(self, bits=KEY_SIZE):
+        from M2Crypto import BIO, RSA
+        gen = RSA.gen_key(bits, PUBLIC_EXPONENT, callback=lambda x,y,z:None)
+        bio_pub = BIO.MemoryBuffer()
+        gen.save_pub_key_bio(bio_pub)
+        bio_pem = BIO.MemoryBuffer()
+        gen.save_key_bio(bio_pem, None)
+        return bio_pub.read(), bio_pem.read()
+
+
+class CryptographyBackend(KeyBackend):
+    name = 'cryptography'
+
+    @classmethod
+    def load(cls):
+        import cryptography.hazmat.primitives.asymmetric.rsa
+        return cryptography
+
+    def generate_key_pair(self, bits=KEY_SIZE):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(
+            public_exponent=PUBLIC_EXPONENT,
+            key_size=bits,
+            backend=default_backend())
+        private_key = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption())
+        public_key = key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        return public_key, private_key
+
+
+# In order of preference, when no backend is configured.
+BACKENDS = [M2CryptoBackend, CryptographyBackend]
+
+
+def get_backend(name=None):
+    """Return an instance of the named backend, or of the first one
+    available.  Raise ValueError if there's no such backend.
+    """
+    for backend in BACKENDS:
+        if name and not backend.name == name:
+            continue
+        if backend.available():
+            return backend()
+        if name:
+            raise ValueError("key backend not installed: {0}".format(name))
+    if name:
+        raise ValueError("unknown key backend: {0}".format(name))
+    raise ValueError("no key backend installed: install M2Crypto or cryptography")
+
+
+def generate_key_pair(bits=KEY_SIZE, backend=None):
+    """Return a new RSA key pair as (public_key, private_key) PEM
+    strings, using the named backend.
+    """
+    return get_backend(backend).generate_key_pair(bits)
+
+
+def format_key(key):
+    """Indent a PEM key for embedding in the minion templates.
+    """
+    return '\n'.join("    {0}".format(k) for k in key.split('\n'))
+
+
+def key_material(public_key, private_key):
+    """Return the key values shaker.template renders for a minion.
+    """
+    return {
+        'public_key': public_key,
+        'private_key': private_key,
+        'formatted_public_key': format_key(public_key),
+        'formatted_private_key': format_key(private_key),
+    }
+
+
+def generate_key_pairs(keynames, bits=KEY_SIZE, backend=None, processes=None):
+    """Generate a key pair for each keyname, spreading the work over
+    worker processes (one per core by default).  Return a dict
+    mapping each keyname to its key_material().
+
+    The workers are fresh interpreters rather than forks: keys are
+    generated while other threads (EC2 requests, logging, the daemon)
+    may hold locks, which a forked child would inherit held.
+    """
+    keynames = list(keynames)
+    if not keynames:
+        return {}
+    # Fail here, rather than in every worker, if the backend is missing.
+    backend = get_backend(backend).name
+    import multiprocessing
+    processes = min(len(keynames), processes or multiprocessing.cpu_count())
+    if processes > 1:
+        counts = [len(keynames) // processes + (i < len(keynames) % processes)
+                  for i in range(processes)]
+        pairs = run_workers(counts, bits, backend)
+    else:
+        pairs = [generate_key_pair(bits, backend) for _ in keynames]
+    return dict(
+        (keyname, key_material(public_key, private_key))
+        for keyname, (public_key, private_key) in zip(keynames, pairs))
+
+
+def run_workers(counts, bits, backend):
+    """Run a worker generating each count of key pairs, returning
+    all the pairs.  Raise ValueError if a worker fails.
+    """
+    import subprocess
+    env = dict(os.environ)
+    # Let the workers import shaker when it runs from a source tree.
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        filter(None, [env.get('PYTHONPATH')]))
+    devnull = open(os.devnull, 'r')
+    workers = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'shaker.keys', str(bits), backend, str(count)],
+            stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            close_fds=True, env=env)
+        for count in counts]
+    pairs = []
+    errors = []
+    for worker in workers:
+        out, err = worker.communicate()
+        if worker.returncode:
+            errors.append(err.strip().split('\n')[-1])
+        else:
+            pairs.extend(tuple(pair) for pair in json.loads(out))
+    if errors:
+        raise ValueError("key generation failed: {0}".format(errors[0]))
+    return pairs
+
+
+def main(args):
+    """Worker of generate_key_pairs: print COUNT key pairs as JSON.
+    """
+    bits, backend, count = args
+    json.dump([generate_key_pair(int(bits), backend)
+               for _ in range(int(count))], sys.stdout)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,8 @@
 import os
 import logging
+import threading
+
+import shaker.fileutil
 
 LOG_LEVELS = {
     'debug': logging.DEBUG,
@@ -9,7 +12,21 @@ LOG_LEVELS = {
     'warning': logging.WARNING,
 }
 
+_started = set()
+_started_lock = threading.Lock()
+
+# The job (e.g. of the daemon, see shaker.server) the current thread
+# works for.  Threads working for a job, such as shaker.pipeline's
+# workers, take on its identity so its log records reach its client.
+_context = threading.local()
+
+
 def start_logger(logname, filename, log_level):
+    # A daemon parses many command lines; only add handlers once.
+    with _started_lock:
+        if (logname, filename) in _started:
+            return
+        _started.add((logname, filename))
     consoleLogger = logging.StreamHandler()
     consoleLogger.setLevel(logging.WARNING)
     logging.getLogger(logname).addHandler(consoleLogger)
@@ -17,8 +34,7 @@ def start_logger(logname, filename, log_level):
         '%(asctime)-6s: %(name)s - %(levelname)s - %(message)s')
 
     directory, _ = os.path.split(filename)
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    shaker.fileutil.make_dir(directory)
 
     fileLogger = logging.FileHandler(filename=filename)
     fileLogger.setLevel(LOG_LEVELS[log_level])
@@ -30,3 +46,11 @@ def start_logger(logname, filename, log_level):
 
 def getLogger(logname):
     return logging.getLogger(logname)
+
+
+def get_job():
+    return getattr(_context, 'job', None)
+
+
+def set_job(job):
+    _context.job = job
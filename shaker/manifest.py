@@ -0,0 +1,102 @@
+"""
+Launch several shaker profiles concurrently from a manifest file.
+
+A manifest is a YAML list.  Each entry is either a profile name, or
+a mapping with a ``profile`` key plus profile values that override
+the named profile for that entry:
+
+    - web
+    - profile: db
+      hostname: db01
+      ec2_instance_type: m1.large
+    - profile: worker
+      hostname: worker{0:02d}
+      count: 4
+
+Each entry runs through the usual EBSFactory.process() steps on its
+own thread, at most ``concurrency`` entries at a time.
+"""
+
+import shaker
+import shaker.config
+import shaker.log
+import shaker.trace
+LOG = shaker.log.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+
+
+def load_manifest(path):
+    """Return the manifest entries as a list of (profile, overrides)
+    tuples, or None if the manifest is invalid.
+    """
+    import yaml
+    try:
+        with open(path, 'r') as f:
+            data = yaml.load(f, Loader=shaker.config.yaml_loader()) or []
+    except (IOError, yaml.YAMLError), err:
+        LOG.error("Unable to read manifest {0}: {1}".format(path, err))
+        return None
+    if not isinstance(data, list):
+        LOG.error("Manifest {0} must be a list of profiles".format(path))
+        return None
+    entries = []
+    for item in data:
+        if isinstance(item, basestring):
+            entries.append((item, {}))
+        elif isinstance(item, dict) and item.get('profile'):
+            overrides = dict(item)
+            profile = overrides.pop('profile')
+            unknown = [k for k in overrides if k not in shaker.config.DEFAULTS]
+            if unknown:
+                LOG.warning("Unknown settings for profile {0}: {1}".format(
+                    profile, ', '.join(unknown)))
+            entries.append((profile, overrides))
+        else:
+            LOG.error("Invalid manifest entry: {0}".format(item))
+            return None
+    return entries
+
+
+def launch_profile(cli, config_dir, profile, overrides, tracer=None):
+    """Build and launch a single manifest entry, returning True on
+    success.  Errors are logged rather than raised so one failing
+    profile doesn't abort the others.
+    """
+    try:
+        factory = shaker.EBSFactory(
+            cli, config_dir, profile, overrides, tracer=tracer)
+        return factory.process()
+    except Exception:
+        LOG.exception("Launching profile {0} failed".format(profile))
+        return False
+
+
+def launch_manifest(cli, config_dir, entries, concurrency=DEFAULT_CONCURRENCY):
+    """Launch all manifest entries on a pool of at most
+    ``concurrency`` threads.  Return True if every entry succeeded.
+    """
+    if not entries:
+        LOG.error("No profiles to launch")
+        return False
+    # Create the default profile up front, rather than racing to
+    # create it from every thread.
+    shaker.config.default_profile(config_dir)
+    tracer = shaker.trace.Tracer()
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(concurrency, len(entries))))
+    try:
+        results = pool.map(
+            lambda entry: launch_profile(
+                cli, config_dir, entry[0], entry[1], tracer),
+            entries)
+    finally:
+        pool.close()
+        pool.join()
+        if cli.trace_file:
+            tracer.save(cli.trace_file)
+            print tracer.format_summary()
+    for (profile, _), result in zip(entries, results):
+        if not result:
+            LOG.error("Profile {0} failed to launch".format(profile))
+    return all(results)
@@ -0,0 +1,88 @@
+"""
+Run the phases of a launch as a small dependency graph.
+
+Each phase is a function returning True on success.  A phase is
+started on a thread pool as soon as all the phases it requires have
+succeeded, so independent phases (e.g. generating keys and verifying
+settings with EC2) overlap.  When a phase fails, the phases depending
+on it are skipped.
+"""
+import sys
+import Queue
+
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+
+
+class Pipeline(object):
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, tracer=None):
+        """With a tracer (see shaker.trace), each phase is recorded
+        as a span.
+        """
+        self.concurrency = concurrency
+        self.tracer = tracer
+        self.phases = []
+        self.results = {}
+
+    def add(self, name, func, requires=()):
+        """Add a phase, run once the named phases have succeeded.
+        """
+        names = [n for n, _, _ in self.phases]
+        for required in requires:
+            if required not in names:
+                raise ValueError("Unknown phase: {0}".format(required))
+        if self.tracer:
+            func = self.tracer.wrap(func, name)
+        self.phases.append((name, func, list(requires)))
+
+    def call(self, name, func, done, job):
+        # Work for the job which started the pipeline, on a pooled
+        # thread.
+        shaker.log.set_job(job)
+        try:
+            done.put((name, bool(func()), None))
+        except Exception:
+            done.put((name, False, sys.exc_info()))
+        finally:
+            shaker.log.set_job(None)
+
+    def run(self):
+        """Run every phase, returning True if all succeeded.  An
+        exception raised by a phase is re-raised once the phases
+        already running have finished.
+        """
+        from multiprocessing.pool import ThreadPool
+        pending = list(self.phases)
+        job = shaker.log.get_job()
+        done = Queue.Queue()
+        running = 0
+        error = None
+        pool = ThreadPool(self.concurrency)
+        try:
+            while pending or running:
+                for phase in list(pending):
+                    name, func, requires = phase
+                    if any(self.results.get(r) is False for r in requires):
+                        LOG.debug("skipping phase {0}".format(name))
+                        self.results[name] = False
+                        pending.remove(phase)
+                    elif all(r in self.results for r in requires):
+                        pending.remove(phase)
+                        pool.apply_async(self.call, (name, func, done, job))
+                        running += 1
+                if not running:
+                    continue
+                # A timeout keeps the wait interruptible with Ctrl-C.
+                name, ok, exc_info = done.get(True, 86400)
+                running -= 1
+                self.results[name] = ok
+                if exc_info and not error:
+                    error = exc_info
+        finally:
+            pool.close()
+            pool.join()
+        if error:
+            raise error[0], error[1], error[2]
+        return all(self.results.values())
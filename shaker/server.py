@@ -0,0 +1,209 @@
+"""
+A long-running shaker daemon: ``shaker serve``.
+
+The daemon listens on a Unix socket and accepts launch and terminate
+jobs, running up to ``concurrency`` of them at once.  EC2 connections,
+compiled templates and parsed profiles stay warm between jobs.
+
+Each job is a single JSON line:
+
+    {"action": "launch", "args": ["--hostname", "web01", "web"],
+     "cwd": "/home/ubuntu"}
+    {"action": "terminate", "instance_ids": ["i-9175d8f4"]}
+
+The daemon replies with a stream of JSON lines: ``log`` events for
+the job's log records, ``output`` events for what shaker would print
+and a final ``done`` event with the job's result.  Relative paths in
+a launch's arguments are resolved against the client's ``cwd``.
+"""
+import os
+import json
+import socket
+import logging
+import optparse
+import threading
+import SocketServer
+
+import shaker
+import shaker.config
+import shaker.log
+import shaker.terminate
+LOG = shaker.log.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+SOCKET_NAME = 'shaker.sock'
+
+
+def get_socket_path(config_dir=None):
+    if os.environ.get('SHAKER_SOCKET'):
+        return os.environ['SHAKER_SOCKET']
+    return os.path.join(shaker.config.get_config_dir(config_dir), SOCKET_NAME)
+
+
+class JobStream(object):
+    """File-like object sending a job's output and progress events
+    back to the client.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, **event):
+        with self.lock:
+            try:
+                self.wfile.write(json.dumps(event) + '\n')
+                self.wfile.flush()
+            except (IOError, OSError):
+                pass  # the client went away, keep running the job
+
+    def write(self, text):
+        self.send(event='output', text=text)
+
+    def flush(self):
+        pass
+
+
+class JobLogHandler(logging.Handler):
+    """Forward log records emitted for a job to its client, from any
+    thread working for the job (see shaker.log.set_job).
+    """
+    def __init__(self, stream):
+        logging.Handler.__init__(self)
+        self.stream = stream
+
+    def emit(self, record):
+        # Handlers run on the thread emitting the record.
+        if shaker.log.get_job() is self:
+            self.stream.send(
+                event='log',
+                level=record.levelname,
+                message=record.getMessage())
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        stream = JobStream(self.wfile)
+        line = self.rfile.readline()
+        if not line:
+            return  # probed by daemon_running
+        try:
+            request = json.loads(line)
+        except ValueError:
+            stream.send(event='done', ok=False, error="invalid request")
+            return
+        handler = JobLogHandler(stream)
+        shaker.log.set_job(handler)
+        logger = shaker.log.getLogger('shaker')
+        logger.addHandler(handler)
+        try:
+            with self.server.slots:
+                ok = self.server.run_job(request, stream)
+        except SystemExit, err:
+            # Raised by the command-line parser for invalid arguments.
+            if isinstance(err.code, int):
+                message = "invalid arguments: {0}".format(
+                    ' '.join(request.get('args', [])))
+            else:
+                message = str(err.code)
+            stream.send(event='log', level='ERROR', message=message)
+            ok = False
+        except Exception, err:
+            LOG.exception("job failed: {0}".format(request))
+            stream.send(event='log', level='ERROR', message=str(err))
+            ok = False
+        finally:
+            logger.removeHandler(handler)
+            shaker.log.set_job(None)
+        stream.send(event='done', ok=bool(ok))
+
+
+def daemon_running(path):
+    """Return True if a daemon answers on the socket.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class ShakerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, config_dir, concurrency=DEFAULT_CONCURRENCY):
+        if os.path.exists(path):
+            # Left behind by a daemon which did not exit cleanly.
+            os.unlink(path)
+        # Create the socket owner-only: jobs run with our credentials.
+        umask = os.umask(077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, JobHandler)
+        finally:
+            os.umask(umask)
+        self.config_dir = config_dir
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.connections = {}
+
+    def run_job(self, request, stream):
+        action = request.get('action')
+        if action == 'launch':
+            return self.launch(
+                request.get('args', []), stream, request.get('cwd'))
+        elif action == 'terminate':
+            failed = shaker.terminate.terminate_instances(
+                request.get('instance_ids', []), self.config_dir, out=stream)
+            return not failed
+        LOG.error("Unknown action: {0}".format(action))
+        return False
+
+    def launch(self, args, stream, cwd=None):
+        cli, config_dir, profile = shaker.parse_cli(args, cwd)
+        if cli.manifest:
+            LOG.error("Submit manifest profiles to the daemon as separate jobs")
+            return False
+        factory = shaker.EBSFactory(cli, config_dir, profile)
+        factory.connections = self.connections
+        factory.out = stream
+        return factory.process()
+
+
+def serve(args=None):
+    parser = optparse.OptionParser(usage="%prog serve [options]")
+    parser.add_option(
+        '--socket', dest='socket', metavar='PATH',
+        help="Unix socket to listen on.  Default: CONFIG_DIR/shaker.sock")
+    parser.add_option(
+        '--config-dir', dest='config_dir',
+        help="Configuration directory")
+    parser.add_option(
+        '--concurrency', dest='concurrency', type='int',
+        metavar='N', default=DEFAULT_CONCURRENCY,
+        help="Run at most N jobs at once.  Default: %default")
+    parser.add_option(
+        '-l', '--log-level', dest='log_level', default='info',
+        choices=shaker.log.LOG_LEVELS.keys())
+    opts, _ = parser.parse_args(args)
+    config_dir = shaker.config.get_config_dir(opts.config_dir)
+    shaker.log.start_logger(
+        'shaker',
+        os.path.join(config_dir, 'shaker.log'),
+        opts.log_level)
+    path = opts.socket or get_socket_path(config_dir)
+    if daemon_running(path):
+        LOG.error("A shaker daemon is already listening on {0}".format(path))
+        return False
+    server = ShakerServer(path, config_dir, opts.concurrency)
+    LOG.info("shaker daemon listening on {0}".format(path))
+    print "shaker daemon listening on {0}".format(path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return True
@@ -0,0 +1,94 @@
+"""
+Accounting of EC2 API calls: ``shaker --stats``.
+
+instrument() hooks a boto EC2 connection's make_request, through
+which every API call is sent, including those made by the instances
+and other objects the connection returns.  For each API action the
+number of calls, the response sizes and the latencies are recorded::
+
+    stats = shaker.stats.instrument(conn)
+    ...
+    print stats.summary()['DescribeInstances']['calls']
+
+EBSFactory instruments a copy of its connection for each launch, so
+the launches of the daemon, which share connections, are counted
+apart.  The stats are exposed as ``stats``.
+"""
+import time
+import threading
+
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values (nearest rank).
+    """
+    if not values:
+        return None
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class CallStats(object):
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, action, seconds, size):
+        with self.lock:
+            self.calls.setdefault(action, []).append((seconds, size))
+
+    def summary(self):
+        """Return a dict mapping each action to its number of calls,
+        total response bytes and latency percentiles in seconds.
+        """
+        with self.lock:
+            calls = dict((a, list(c)) for a, c in self.calls.items())
+        summary = {}
+        for action, samples in calls.items():
+            latencies = sorted(s for s, _ in samples)
+            summary[action] = {
+                'calls': len(samples),
+                'bytes': sum(size for _, size in samples),
+                'max': latencies[-1],
+            }
+            for p in PERCENTILES:
+                summary[action]['p{0}'.format(p)] = percentile(latencies, p)
+        return summary
+
+    def format_summary(self):
+        lines = ["{0:<28} {1:>6} {2:>10} {3:>8} {4:>8} {5:>8} {6:>8}".format(
+            'action', 'calls', 'bytes', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        summary = self.summary()
+        for action in sorted(summary, key=lambda a: -summary[a]['calls']):
+            s = summary[action]
+            lines.append(
+                "{0:<28} {1:>6} {2:>10} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f}".format(
+                    action, s['calls'], s['bytes'], s['p50'] * 1000,
+                    s['p90'] * 1000, s['p99'] * 1000, s['max'] * 1000))
+        return '\n'.join(lines)
+
+
+def instrument(conn):
+    """Record the connection's API calls, returning a new CallStats.
+    Calls which raise (e.g. once shaker.ec2 gives up retrying) are
+    recorded with a size of 0.
+    """
+    stats = CallStats()
+    make_request = conn.make_request
+
+    def instrumented(action, *args, **kwargs):
+        start = time.time()
+        size = 0
+        try:
+            response = make_request(action, *args, **kwargs)
+            # boto caches the body, so reading it here costs nothing more.
+            size = len(response.read() or '')
+            return response
+        finally:
+            stats.record(action, time.time() - start, size)
+    conn.make_request = instrumented
+    return stats
@@ -5,14 +5,31 @@ Handle the templates to configure user-data.
 """
 import os
 import re
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
+import gzip
+import StringIO
+import email
 
 from shaker import __version__
 
+import shaker.fileutil
 import shaker.log
 LOG = shaker.log.getLogger(__name__)
 
+# Jinja environments, and with them the compiled templates, are kept
+# for the life of the process (e.g. a fleet launch or the daemon).
+# Across processes, compiled templates are reused from the bytecode
+# cache in the template directory.
+_environments = {}
+# Per-host variable uses of templates, keyed by path, mtime and size.
+_template_uses = {}
+
+BYTECODE_CACHE_DIR = '.cache'
+
+USER_DATA_LIMIT = 16384  # bytes, before base64 encoding
+
+# Stands in for a per-host value in a batch skeleton, see BatchUserData.
+MARKER = re.compile('\x00(\w+)\x00')
+
 CLOUD_INIT_PREFIX = 'cloud-init'
 USER_SCRIPT_PREFIX = 'user-script'
 BOOTHOOK_SCRIPT_PREFIX = 'boothook-script'
@@ -22,19 +39,40 @@ class UserData(object):
     def __init__(self, config):
         self.config = config
         self.config.update({'version': __version__})
+        self.template_paths = []
         self.template_dir = self.get_template_dir(self.config['config_dir'])
-        self.env = self.get_jinja_env()
         minion_template = re.sub('\n\n+', '\n\n', self.render_template('minion_template', default_contents=MINION_TEMPLATE))
         self.config['rendered_minion_template'] = minion_template
         self.user_script = re.sub('\n\n+', '\n\n', self.render_template('user_data_template', default_contents=USER_SCRIPT))
         self.boothook_script = re.sub('\n\n+', '\n\n', self.render_template('boothook_template', default_contents=BOOTHOOK_SCRIPT))
         self.cloud_init = re.sub('\n\n+', '\n\n', self.render_template('cloud_init_template', default_contents=CLOUD_INIT))
 
-    def get_jinja_env(self):
-        ## Using '/' in loader allows to check for absolute paths.
-        loader = FileSystemLoader([os.getcwd(), self.template_dir, '/'])
-        env = Environment(loader=loader)
-        return env
+    def get_jinja_env(self, directory):
+        """Return the environment loading templates from directory,
+        with compiled templates cached in the template directory.
+        """
+        key = (directory, self.template_dir)
+        if key not in _environments:
+            from jinja2 import Environment
+            from jinja2 import FileSystemLoader
+            from jinja2 import FileSystemBytecodeCache
+            cache_dir = os.path.join(self.template_dir, BYTECODE_CACHE_DIR)
+            shaker.fileutil.make_dir(cache_dir)
+            _environments[key] = Environment(
+                loader=FileSystemLoader([directory]),
+                bytecode_cache=FileSystemBytecodeCache(cache_dir))
+        return _environments[key]
+
+    def find_template(self, template_name):
+        """Return the absolute path of a template named in the
+        profile, looked up in the working directory, then the
+        template directory.
+        """
+        if os.path.isabs(template_name):
+            return template_name
+        if os.path.isfile(template_name):
+            return os.path.abspath(template_name)
+        return os.path.join(self.template_dir, template_name)
 
     def render_template(self, template_arg, default_contents=None):
         """
@@ -53,22 +91,212 @@ class UserData(object):
             template_path = os.path.join(self.template_dir, template_name)
             ## Create from default if it doesn't exist.
             if not os.path.isfile(template_path):
-                template_file = open(template_path, 'w')
-                template_file.write(default_contents)
-                template_file.close()
+                # Concurrent launches never read a partially
+                # written template.
+                shaker.fileutil.atomic_write(template_path, default_contents)
         else:
-            template_name = self.config[template_arg]
+            template_path = self.find_template(self.config[template_arg])
 
-        return self.env.get_template(template_name).render(self.config)
+        self.template_paths.append(template_path)
+        env = self.get_jinja_env(os.path.dirname(template_path))
+        template = env.get_template(os.path.basename(template_path))
+        return template.render(self.config)
 
     def get_template_dir(self, config_dir):
         """Return the template directory name, creating the
         directory if absent (and populating with boilerplate).
         """
-        template_dir = os.path.join(config_dir, 'templates')
-        if not os.path.isdir(template_dir):
-            os.makedirs(template_dir)
-        return template_dir
+        return shaker.fileutil.make_dir(os.path.join(config_dir, 'templates'))
+
+    def parts(self):
+        return [
+            (self.user_script, 'x-shellscript', 'user-script.txt'),
+            (self.cloud_init, 'cloud-config', 'cloud-config.txt'),
+            (self.boothook_script, 'cloud-boothook', 'boothook-script.txt'),
+        ]
+
+
+def mime_multipart(parts):
+    """Return the MIME multipart user data for a list of
+    (content, subtype, filename) parts.
+    """
+    import email.mime.multipart
+    import email.mime.text
+    outer = email.mime.multipart.MIMEMultipart()
+    for content, subtype, filename in parts:
+        msg = email.mime.text.MIMEText(content, _subtype=subtype)
+        msg.add_header('Content-Disposition',
+                       'attachment',
+                       filename=filename)
+        outer.attach(msg)
+    return outer.as_string()
+
+
+def gzip_compress(data):
+    """Return data gzip-compressed.  The timestamp is fixed, so equal
+    payloads compress identically.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def part_sizes(payload):
+    """Return (filename, raw size, compressed size) for each part of
+    a MIME payload.
+    """
+    sizes = []
+    for part in email.message_from_string(payload).get_payload():
+        content = part.get_payload()
+        sizes.append(
+            (part.get_filename(), len(content), len(gzip_compress(content))))
+    return sizes
+
+
+class BatchUserData(object):
+    """Iterate over the MIME user data of a batch of hosts.
+
+    Only the values differing between hosts (typically hostname,
+    salt_id and keys) are rendered per host.  The templates are
+    rendered once for each combination of those values being set or
+    not, with markers in place of the values, into a finished MIME
+    payload.  A host's payload is then its skeleton with the markers
+    replaced.
+
+    Skeletons are only used when the templates do no more with the
+    per-host values than print them or test whether they are set (see
+    uses_values); otherwise, e.g. for a template branching on the
+    hostname, every host is rendered in full.  Each skeleton is also
+    checked against a full rendering of the first host using it.
+    Hosts rendering identically get identical payloads, so they can
+    be launched in a single request.
+    """
+    def __init__(self, configs):
+        self.configs = list(configs)
+        self.varying = varying_keys(self.configs)
+        self.skeletons = {}
+
+    def __iter__(self):
+        for config in self.configs:
+            yield self.render(config)
+
+    def render(self, config):
+        values = dict((key, config.get(key)) for key in self.varying)
+        if any(isinstance(v, basestring) and '\n\n' in v
+               for v in values.values()):
+            # Blank lines are squeezed after rendering, see UserData.
+            return mime_multipart(UserData(dict(config)).parts())
+        shape = tuple(sorted((key, bool(value)) for key, value in values.items()))
+        if shape not in self.skeletons:
+            self.skeletons[shape] = self.build_skeleton(config, values)
+        skeleton = self.skeletons[shape]
+        if skeleton is None:
+            return mime_multipart(UserData(dict(config)).parts())
+        return fill(skeleton, values)
+
+    def build_skeleton(self, config, values):
+        """Return the payload with markers for the host's values,
+        or None if the templates can't be rendered that way.
+        """
+        marked = dict(config)
+        for key, value in values.items():
+            if value and not isinstance(value, basestring):
+                return None
+            if value:
+                marked[key] = '\x00{0}\x00'.format(key)
+        user_data = UserData(marked)
+        keys = [key for key, value in values.items() if value]
+        if any(uses_values(path, keys) for path in user_data.template_paths):
+            LOG.debug("templates use per-host values, rendering each host")
+            return None
+        parts = user_data.parts()
+        if any(values.values()):
+            expected = UserData(dict(config)).parts()
+            for (content, _, _), (full, _, _) in zip(parts, expected):
+                if not fill(content, values) == full:
+                    LOG.debug("templates use per-host values, rendering each host")
+                    return None
+        return mime_multipart(parts)
+
+
+def uses_values(template_path, keys):
+    """Return True if the template uses any of the variables named
+    by keys other than by printing them as they are ({{ key }}) or
+    testing whether they are set ({% if key %}, {% if a and not b %}).
+    Templates including, importing or extending others are assumed
+    to.
+    """
+    if not keys:
+        return False
+    st = os.stat(template_path)
+    cache_key = (template_path, st.st_mtime, st.st_size)
+    if cache_key not in _template_uses:
+        _template_uses[cache_key] = template_uses(template_path)
+    uses = _template_uses[cache_key]
+    return uses is None or bool(uses.intersection(keys))
+
+
+def printed_or_tested(name, ancestors):
+    """Return True if the Name node is printed as it is, or only
+    tested for truth in an if, possibly combined with and, or, not.
+    """
+    from jinja2 import nodes
+    if ancestors and isinstance(ancestors[-1], nodes.Output):
+        return True
+    node = name
+    for parent in reversed(ancestors):
+        if isinstance(parent, nodes.If):
+            return parent.test is node
+        if not isinstance(parent, (nodes.And, nodes.Or, nodes.Not)):
+            return False
+        node = parent
+    return False
+
+
+def template_uses(template_path):
+    """Return the names of the variables the template uses beyond
+    printing or testing them, or None if it includes other templates.
+    """
+    from jinja2 import Environment
+    from jinja2 import nodes
+    with open(template_path, 'r') as f:
+        ast = Environment().parse(f.read().decode('utf-8'))
+    if any(ast.find_all((nodes.Include, nodes.Import, nodes.FromImport,
+                         nodes.Extends))):
+        return None
+    uses = set()
+
+    def visit(node, ancestors):
+        if (isinstance(node, nodes.Name) and node.ctx == 'load' and
+            not printed_or_tested(node, ancestors)):
+            uses.add(node.name)
+        for child in node.iter_child_nodes():
+            visit(child, ancestors + [node])
+    visit(ast, [])
+    return uses
+
+
+def fill(skeleton, values):
+    """Replace the markers in a skeleton with the host's values.
+    """
+    return MARKER.sub(lambda m: values.get(m.group(1), m.group(0)), skeleton)
+
+
+def varying_keys(configs):
+    """Return the keys whose values differ between configs.
+    """
+    if not configs:
+        return []
+    first = configs[0]
+    keys = set()
+    for config in configs[1:]:
+        keys.update(k for k in set(first) | set(config)
+                    if not first.get(k) == config.get(k))
+    return sorted(keys)
 
 
 CLOUD_INIT = """#cloud-config
@@ -0,0 +1,175 @@
+"""
+Terminate instances in whichever region they run.
+
+The region owning each instance is taken from the hint file that
+shaker maintains in the config directory when it launches instances.
+Instances without a hint are located by querying every region
+concurrently, filtered by instance id, stopping as soon as all of
+them are found, as are instances EC2 no longer finds in their hinted
+region.  Each region then gets a single TerminateInstances call for
+all of its instances; a region's errors only fail its own instances.
+"""
+import os
+import sys
+
+import shaker.ec2
+import shaker.fileutil
+import shaker.inventory
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+REGION_HINTS_FILE = 'instance-regions'
+
+
+def get_region_hints_path(config_dir):
+    return os.path.join(config_dir, REGION_HINTS_FILE)
+
+
+def read_region_hints(config_dir):
+    """Return a dict mapping instance ids to their region names.
+    """
+    hints = {}
+    if not config_dir:
+        return hints
+    try:
+        with open(get_region_hints_path(config_dir), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    hints[fields[0]] = fields[1]
+    except IOError:
+        pass
+    return hints
+
+
+def record_instance_regions(config_dir, instance_ids, region):
+    """Remember the region of newly launched instances.
+    """
+    with open(get_region_hints_path(config_dir), 'a') as f:
+        f.write(''.join(
+            "{0} {1}\n".format(id, region) for id in instance_ids))
+
+
+def forget_instances(config_dir, instance_ids):
+    """Drop terminated instances from the hint file.
+    """
+    hints = read_region_hints(config_dir)
+    if not any(id in hints for id in instance_ids):
+        return
+    for id in instance_ids:
+        hints.pop(id, None)
+    shaker.fileutil.atomic_write(
+        get_region_hints_path(config_dir),
+        ''.join("{0} {1}\n".format(id, region)
+                for id, region in hints.items()))
+
+
+def find_in_region(region, instance_ids):
+    """Return (region name, connection, ids of the instances found
+    in the region).
+    """
+    import boto.exception
+    conn = region.connect()
+    shaker.ec2.install(conn, region.name)
+    try:
+        reservations = conn.get_all_instances(
+            filters={'instance-id': list(instance_ids)})
+    except (boto.exception.BotoServerError,) + tuple(conn.http_exceptions), err:
+        LOG.debug("unable to search region {0}: {1}".format(
+            region.name, err))
+        return region.name, None, []
+    found = [i.id for r in reservations for i in r.instances]
+    return region.name, conn, found
+
+
+def terminate_in_region(region, conn, instance_ids):
+    """Terminate the instances of a region, returning (ids terminated,
+    EC2 error code or None).  Errors are logged.
+    """
+    import boto.exception
+    try:
+        return [i.id for i in conn.terminate_instances(
+            instance_ids=instance_ids)], None
+    except boto.exception.BotoServerError, err:
+        code = err.error_code
+        message = err.error_message or err.reason
+    except tuple(conn.http_exceptions), err:
+        code = None
+        message = str(err) or err.__class__.__name__
+    if not code == 'InvalidInstanceID.NotFound':
+        LOG.error("Unable to terminate {0} in {1}: {2}".format(
+            ', '.join(instance_ids), region, message))
+    return [], code
+
+
+def locate_instances(instance_ids, concurrency=None):
+    """Search all regions concurrently, returning a dict mapping
+    region names to (connection, instance ids).  The search stops as
+    soon as every instance has been found.
+    """
+    import boto.ec2
+    from multiprocessing.pool import ThreadPool
+    regions = boto.ec2.regions()
+    pool = ThreadPool(concurrency or len(regions))
+    located = {}
+    missing = set(instance_ids)
+    try:
+        for name, conn, found in pool.imap_unordered(
+            lambda region: find_in_region(region, instance_ids),
+            regions):
+            if found:
+                located[name] = (conn, found)
+                missing.difference_update(found)
+            if not missing:
+                break
+    finally:
+        pool.terminate()
+    return located
+
+
+def terminate_instances(instance_ids, config_dir=None, out=sys.stdout):
+    """Terminate the instances, with one request per region.  Return
+    the ids which could not be terminated.
+    """
+    hints = read_region_hints(config_dir)
+    by_region = {}
+    unknown = []
+    for id in instance_ids:
+        if id in hints:
+            by_region.setdefault(hints[id], []).append(id)
+        else:
+            unknown.append(id)
+    terminated = {}
+    for region, ids in by_region.items():
+        conn = shaker.ec2.connect(region)
+        if not conn:
+            unknown.extend(ids)
+            continue
+        terminated[region], code = terminate_in_region(region, conn, ids)
+        if code == 'InvalidInstanceID.NotFound':
+            # A stale hint: fall back to searching every region.
+            LOG.debug("instances not found in hinted region {0}".format(region))
+            unknown.extend(ids)
+    located = {}
+    if unknown:
+        located = locate_instances(unknown)
+        for region, (conn, ids) in located.items():
+            terminated.setdefault(region, []).extend(
+                terminate_in_region(region, conn, ids)[0])
+    for region, ids in terminated.items():
+        for id in ids:
+            print >>out, "Terminating instance: {0}".format(id)
+        if config_dir:
+            inventory = shaker.inventory.Inventory(config_dir, region)
+            inventory.remove_instances(ids)
+            inventory.save()
+    terminated = [id for ids in terminated.values() for id in ids]
+    # Instances found nowhere are gone, e.g. terminated outside shaker.
+    found = set(id for _, ids in located.values() for id in ids)
+    gone = [id for id in unknown if id not in found]
+    if config_dir and (terminated or gone):
+        forget_instances(config_dir, terminated + gone)
+    failed = [id for id in instance_ids if id not in terminated]
+    for id in failed:
+        print >>out, "Unable to terminate instance: {0}".format(id)
+    return failed
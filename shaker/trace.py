@@ -0,0 +1,106 @@
+"""
+Span tracing of launches: ``shaker --trace FILE``.
+
+Every phase of a launch and every EC2 API call is recorded as a span
+with its start time, duration and thread.  The trace is written in
+the Chrome trace-event format, which chrome://tracing and Perfetto
+display as a timeline, and a summary of the wall time spent in each
+phase is printed.
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+
+class Tracer(object):
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self.lock:
+                self.spans.append((
+                    name,
+                    category,
+                    start,
+                    end,
+                    threading.current_thread().ident,
+                    args))
+
+    def wrap(self, func, name, category='phase'):
+        """Return func, recording a span for each call.
+        """
+        def traced(*args, **kwargs):
+            with self.span(name, category):
+                return func(*args, **kwargs)
+        return traced
+
+    def chrome_trace(self):
+        """Return the spans as a Chrome trace-event document.
+        """
+        pid = os.getpid()
+        events = []
+        for name, category, start, end, thread, args in self.spans:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': pid,
+                'tid': thread,
+                'args': args,
+            })
+        events.sort(key=lambda e: e['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        LOG.info("trace written to {0}".format(path))
+
+    def summary(self):
+        """Return (category, name, calls, seconds) for each phase and
+        API call, in the order they were first started.
+        """
+        totals = {}
+        first = {}
+        for name, category, start, end, _, _ in self.spans:
+            key = (category, name)
+            calls, seconds = totals.get(key, (0, 0.0))
+            totals[key] = (calls + 1, seconds + end - start)
+            first[key] = min(first.get(key, start), start)
+        return [key + totals[key] for key in sorted(totals, key=first.get)]
+
+    def format_summary(self):
+        lines = ["{0:<8} {1:<24} {2:>6} {3:>10}".format(
+            'type', 'name', 'calls', 'wall ms')]
+        for category, name, calls, seconds in self.summary():
+            lines.append("{0:<8} {1:<24} {2:>6} {3:>10.1f}".format(
+                category, name, calls, seconds * 1000))
+        return '\n'.join(lines)
+
+
+class TracedConnection(object):
+    """Proxy for an EC2 connection recording a span for each API call.
+    """
+    def __init__(self, conn, tracer):
+        self._conn = conn
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if callable(attr) and not name.startswith('_'):
+            return self._tracer.wrap(attr, name, 'ec2')
+        return attr
@@ -0,0 +1,111 @@
+"""
+Content-addressed store of the user data written with -w.
+
+Each distinct payload is written once, as ``userdata/objects/<sha1>``.
+``userdata/<keyname>`` is a symlink to the host's payload, so it can
+be read as before.  ``userdata/index.json`` maps each keyname to its
+payload's digest, for listing which hosts share a payload:
+
+    $ shaker userdata
+"""
+import os
+import json
+import hashlib
+import optparse
+import threading
+
+import shaker.config
+import shaker.fileutil
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+OBJECTS_DIR = 'objects'
+INDEX_FILE = 'index.json'
+
+_lock = threading.Lock()
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class UserDataStore(object):
+    def __init__(self, userdata_dir):
+        self.userdata_dir = userdata_dir
+        self.objects_dir = os.path.join(userdata_dir, OBJECTS_DIR)
+        self.index_path = os.path.join(userdata_dir, INDEX_FILE)
+        self.added = {}
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def add(self, keyname, data):
+        """Store the host's user data, returning the path it can be
+        read from.  The payload is only written if it isn't stored
+        yet.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        d = digest(data)
+        object_path = os.path.join(self.objects_dir, d)
+        if not os.path.isfile(object_path):
+            shaker.fileutil.make_dir(self.objects_dir)
+            shaker.fileutil.atomic_write(object_path, data)
+        pathname = os.path.join(self.userdata_dir, keyname)
+        target = os.path.join(OBJECTS_DIR, d)
+        if not (os.path.islink(pathname) and os.readlink(pathname) == target):
+            # Replace the pointer (or a copy written by an older
+            # shaker) atomically.
+            tmp_path = "{0}.{1}.tmp".format(pathname, os.getpid())
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            os.symlink(target, tmp_path)
+            os.rename(tmp_path, pathname)
+        self.added[keyname] = d
+        return pathname
+
+    def save(self):
+        """Record the hosts added in this run in the index, merging
+        with any recorded concurrently by other shaker processes.
+        """
+        if not self.added:
+            return
+        with _lock:
+            index = self.load_index()
+            index.update(self.added)
+            shaker.fileutil.atomic_write(
+                self.index_path, json.dumps(index, indent=1, sort_keys=True))
+        self.added = {}
+
+    def hosts_by_payload(self):
+        """Return a dict mapping each payload digest to the sorted
+        keynames of the hosts using it.
+        """
+        groups = {}
+        for keyname, d in self.load_index().items():
+            groups.setdefault(d, []).append(keyname)
+        for keynames in groups.values():
+            keynames.sort()
+        return groups
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%prog userdata [options]")
+    parser.add_option(
+        '--config-dir', dest='config_dir',
+        help="Configuration directory")
+    opts, args = parser.parse_args(args)
+    config_dir = shaker.config.get_config_dir(opts.config_dir)
+    store = UserDataStore(shaker.config.get_userdata_dir(config_dir))
+    groups = store.hosts_by_payload()
+    for d, keynames in sorted(groups.items(), key=lambda g: g[1]):
+        print "{0} {1}".format(d, ' '.join(keynames))
+
+
+if __name__ == '__main__':
+    main()
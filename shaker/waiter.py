@@ -0,0 +1,87 @@
+"""
+Wait for launched instances to reach the running state.
+
+All pending instances are polled together, with one filtered
+DescribeInstances call per round.  The interval between rounds
+starts short and backs off, with jitter, so an instance is returned
+soon after it is running without hammering the API on slow launches.
+"""
+import random
+import time
+
+import shaker.log
+LOG = shaker.log.getLogger(__name__)
+
+RUN_INSTANCE_TIMEOUT = 180  # seconds
+INITIAL_INTERVAL = 1.0  # seconds
+MAX_INTERVAL = 15.0  # seconds
+BACKOFF = 1.5
+
+
+class InstanceWaiter(object):
+    def __init__(self, conn, timeout=RUN_INSTANCE_TIMEOUT,
+                 initial_interval=INITIAL_INTERVAL,
+                 max_interval=MAX_INTERVAL,
+                 backoff=BACKOFF):
+        self.conn = conn
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timed_out = []
+
+    def wait(self, instances):
+        """Yield each instance as soon as it is running.  Instances
+        still pending when the timeout expires are logged and left
+        in self.timed_out.
+        """
+        pending = {}
+        for instance in instances:
+            if instance.state == 'running':
+                yield instance
+            else:
+                pending[instance.id] = instance
+        deadline = time.time() + self.timeout
+        interval = self.initial_interval
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, random.uniform(interval / 2, interval)))
+            interval = min(interval * self.backoff, self.max_interval)
+            for instance in self.poll(pending):
+                del pending[instance.id]
+                yield instance
+        self.timed_out = pending.values()
+        for instance in self.timed_out:
+            errmsg = "run instance {0} failed after {1} seconds".format(
+                instance.id, self.timeout)
+            LOG.error(errmsg)
+
+    def poll(self, pending):
+        """Return the pending instances which are now running,
+        refreshed with their current attributes.
+        """
+        import boto.exception
+        try:
+            reservations = self.conn.get_all_instances(
+                instance_ids=pending.keys(),
+                filters={'instance-state-name': 'running'})
+        except boto.exception.BotoServerError, err:
+            # Newly launched instances may not be visible yet; other
+            # errors, left after shaker.ec2's retries, are retried on
+            # the next round.
+            if err.error_code == 'InvalidInstanceID.NotFound':
+                LOG.debug("describe instances failed: {0}".format(err))
+            else:
+                LOG.warning("describe instances failed: {0}".format(
+                    err.error_message or err.reason))
+            return []
+        running = []
+        for reservation in reservations:
+            for updated in reservation.instances:
+                instance = pending.get(updated.id)
+                if instance is not None:
+                    instance._update(updated)
+                    running.append(instance)
+        return running
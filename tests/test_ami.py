@@ -0,0 +1,41 @@
+import json
+import unittest
+
+import shaker.ami
+
+
+def synced_index(images):
+    return shaker.ami.build_synced_index(json.dumps({
+        'version': 1,
+        'distros': ['ubuntu'],
+        'images': images,
+    }))['amis']
+
+
+class SyncedIndexTest(unittest.TestCase):
+    def test_ssd_and_io1_stores_are_indexed(self):
+        amis = synced_index({
+            'ubuntu/xenial/us-east-1/x86_64/io1/hvm': 'ami-io1',
+            'ubuntu/xenial/us-east-1/x86_64/ssd/hvm': 'ami-ssd',
+            'ubuntu/bionic/us-east-1/x86_64/io1/hvm': 'ami-bionic',
+        })
+        self.assertEqual(amis['ubuntu/xenial/us-east-1/x86_64'], 'ami-ssd')
+        self.assertEqual(amis['ubuntu/bionic/us-east-1/x86_64'], 'ami-bionic')
+
+    def test_instance_store_is_left_out(self):
+        amis = synced_index({
+            'ubuntu/xenial/us-east-1/x86_64/instance-store/hvm': 'ami-is',
+        })
+        self.assertEqual(amis, {})
+
+    def test_paravirtual_standard_ebs_is_preferred(self):
+        amis = synced_index({
+            'ubuntu/precise/us-east-1/i386/ebs/hvm': 'ami-hvm',
+            'ubuntu/precise/us-east-1/i386/ssd/paravirtual': 'ami-ssd-pv',
+            'ubuntu/precise/us-east-1/i386/ebs/paravirtual': 'ami-pv',
+        })
+        self.assertEqual(amis['ubuntu/precise/us-east-1/i386'], 'ami-pv')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import socket
+import unittest
+
+import boto.exception
+
+import shaker.ec2
+
+THROTTLED = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+             '</Error></Errors></Response>')
+INTERNAL_ERROR = ('<Response><Errors><Error><Code>InternalError</Code>'
+                  '</Error></Errors></Response>')
+
+
+class FakeClock(object):
+    """Stand-in for the time module, sleeping instantly.  Tests use
+    rates whose intervals are exact in binary, so the clock adds up.
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Response(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = shaker.ec2.time
+        shaker.ec2.time = self.clock
+
+    def tearDown(self):
+        shaker.ec2.time = self.time
+
+
+class TokenBucketTest(ClockTestCase):
+    def test_bursts_then_paces(self):
+        bucket = shaker.ec2.TokenBucket(8)
+        for _ in range(8):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        for _ in range(8):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.125] * 8)
+
+    def test_zero_rate_is_unlimited(self):
+        bucket = shaker.ec2.TokenBucket(0)
+        for _ in range(100):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_drain_slows_the_next_request(self):
+        bucket = shaker.ec2.TokenBucket(8)
+        bucket.drain()
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.125])
+
+
+class LimiterTest(ClockTestCase):
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.limiter = shaker.ec2.Limiter('us-east-1', rate=0, max_retries=3)
+        self.requests = []
+
+    def make_request(self, *outcomes):
+        """Return a make_request giving each outcome in turn: a
+        Response to return or an exception to raise.
+        """
+        outcomes = list(outcomes)
+
+        def make_request(action, params=None):
+            self.requests.append(action)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return make_request
+
+    def call(self, make_request, action, params=None):
+        return self.limiter.call(
+            make_request, (socket.error,), action, params)
+
+    def server_error(self):
+        return boto.exception.BotoServerError(
+            500, 'Internal Server Error', INTERNAL_ERROR)
+
+    def test_throttles_are_retried(self):
+        ok = Response(200)
+        response = self.call(
+            self.make_request(Response(503, THROTTLED), ok), 'RunInstances')
+        self.assertTrue(response is ok)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual((self.limiter.throttled, self.limiter.retried), (1, 1))
+        self.assertEqual(len(self.clock.sleeps), 1)
+
+    def test_server_errors_of_non_idempotent_calls_are_raised(self):
+        self.assertRaises(
+            boto.exception.BotoServerError, self.call,
+            self.make_request(self.server_error(), Response(200)),
+            'RunInstances', {'ImageId': 'ami-1'})
+        self.assertEqual(len(self.requests), 1)
+
+    def test_server_errors_are_retried_with_a_client_token(self):
+        self.call(self.make_request(self.server_error(), Response(200)),
+                  'RunInstances', {'ClientToken': 'token'})
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual((self.limiter.throttled, self.limiter.retried), (0, 1))
+
+    def test_network_errors_of_lookups_are_retried(self):
+        self.call(self.make_request(socket.error('reset'), Response(200)),
+                  'DescribeInstances')
+        self.assertEqual(len(self.requests), 2)
+
+    def test_client_errors_are_returned(self):
+        response = Response(400, '<Code>InvalidAMIID.NotFound</Code>')
+        self.assertTrue(self.call(
+            self.make_request(response), 'DescribeImages') is response)
+        self.assertEqual(self.limiter.retried, 0)
+
+    def test_gives_up_after_max_retries(self):
+        self.assertRaises(
+            boto.exception.BotoServerError, self.call,
+            self.make_request(*[self.server_error()] * 4),
+            'DescribeInstances')
+        self.assertEqual(len(self.requests), 4)
+        throttled = Response(503, THROTTLED)
+        self.assertTrue(self.call(
+            self.make_request(*[throttled] * 4), 'CreateTags') is throttled)
+        self.assertEqual(self.limiter.retried, 6)
+
+    def test_backoff_is_capped(self):
+        for attempt in range(20):
+            delay = shaker.ec2.backoff(attempt)
+            self.assertTrue(0 <= delay <= shaker.ec2.MAX_DELAY)
+
+
+if __name__ == '__main__':
+    unittest.main()
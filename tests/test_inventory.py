@@ -0,0 +1,49 @@
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import shaker.inventory
+
+
+def save_name(config_dir, name):
+    inventory = shaker.inventory.Inventory(config_dir, 'us-east-1')
+    inventory.update('names', name, 'i-' + name)
+    inventory.save()
+
+
+class InventorySaveTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def test_concurrent_processes_merge_their_facts(self):
+        names = ['web{0:02d}'.format(i) for i in range(20)]
+        processes = [
+            multiprocessing.Process(
+                target=save_name, args=(self.config_dir, name))
+            for name in names]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        inventory = shaker.inventory.Inventory(self.config_dir, 'us-east-1')
+        for name in names:
+            self.assertEqual(
+                inventory.lookup('names', name), (True, 'i-' + name))
+
+    def test_save_keeps_facts_it_did_not_update(self):
+        save_name(self.config_dir, 'web01')
+        inventory = shaker.inventory.Inventory(self.config_dir, 'us-east-1')
+        save_name(self.config_dir, 'web02')
+        inventory.update('names', 'web03', 'i-web03')
+        inventory.save()
+        inventory = shaker.inventory.Inventory(self.config_dir, 'us-east-1')
+        self.assertEqual(sorted(inventory.data['names']),
+                         ['web01', 'web02', 'web03'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import shutil
+import tempfile
+import unittest
+
+import shaker
+import shaker.config
+import shaker.template
+
+
+def make_factory(count, config):
+    """Return an EBSFactory with just the state get_minions and
+    group_by_user_data use, without parsing a command line.
+    """
+    factory = shaker.EBSFactory.__new__(shaker.EBSFactory)
+    factory.count = count
+    factory.config = config
+    return factory
+
+
+class ExpandPatternTest(unittest.TestCase):
+    def test_format_field(self):
+        self.assertEqual(shaker.expand_pattern('web{0:02d}', 3, 10), 'web03')
+        self.assertEqual(shaker.expand_pattern('web{0}.dc1', 12, 20),
+                         'web12.dc1')
+
+    def test_index_appended_for_fleets(self):
+        self.assertEqual(shaker.expand_pattern('web', 2, 3), 'web2')
+
+    def test_single_host_unchanged(self):
+        self.assertEqual(shaker.expand_pattern('web', 1, 1), 'web')
+
+
+class GetMinionsTest(unittest.TestCase):
+    def test_hostname_and_salt_id_expanded(self):
+        minions = make_factory(3, {
+            'hostname': 'web{0:02d}',
+            'salt_id': 'web{0:02d}.example.com',
+            'ami_id': 'ami-1',
+        }).get_minions()
+        self.assertEqual([m.config['hostname'] for m in minions],
+                         ['web01', 'web02', 'web03'])
+        self.assertEqual([m.config['salt_id'] for m in minions],
+                         ['web01.example.com', 'web02.example.com',
+                          'web03.example.com'])
+        self.assertTrue(all(m.config['ami_id'] == 'ami-1' for m in minions))
+
+    def test_invalid_patterns(self):
+        for pattern in ['web{1}', 'web{name}', 'web{0:q}']:
+            self.assertEqual(
+                make_factory(2, {'hostname': pattern}).get_minions(), [])
+
+    def test_invalid_count(self):
+        self.assertEqual(make_factory('two', {'hostname': 'web'}).get_minions(), [])
+        self.assertEqual(make_factory(-1, {'hostname': 'web'}).get_minions(), [])
+
+
+class GroupByUserDataTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def test_groups_in_launch_order(self):
+        factory = make_factory(4, {'hostname': 'web{0}'})
+        factory.minions = factory.get_minions()
+        for minion, user_data in zip(factory.minions, 'abab'):
+            minion.user_data = user_data
+        groups = factory.group_by_user_data()
+        self.assertEqual(
+            [(u, [m.config['hostname'] for m in ms]) for u, ms in groups],
+            [('a', ['web1', 'web3']), ('b', ['web2', 'web4'])])
+
+    def groups(self, hostname):
+        config = dict(shaker.config.DEFAULTS, config_dir=self.config_dir,
+                      hostname=hostname, salt_master='salt.example.com')
+        factory = make_factory(3, config)
+        factory.minions = factory.get_minions()
+        batch = shaker.template.BatchUserData(
+            m.config for m in factory.minions)
+        for minion, user_data in zip(factory.minions, batch):
+            minion.user_data = user_data
+        return factory.group_by_user_data()
+
+    def test_unnamed_hosts_share_user_data(self):
+        groups = self.groups(None)
+        self.assertEqual([len(minions) for _, minions in groups], [3])
+
+    def test_named_hosts_have_their_own_user_data(self):
+        groups = self.groups('web{0}')
+        self.assertEqual([len(minions) for _, minions in groups], [1, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
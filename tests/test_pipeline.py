@@ -0,0 +1,77 @@
+import threading
+import unittest
+
+import shaker.pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = shaker.pipeline.Pipeline()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def phase(self, name, ok=True):
+        def run():
+            with self.lock:
+                self.calls.append(name)
+            return ok
+        return run
+
+    def test_phases_run_after_their_requirements(self):
+        self.pipeline.add('keys', self.phase('keys'))
+        self.pipeline.add('verify', self.phase('verify'))
+        self.pipeline.add('user_data', self.phase('user_data'), ['keys'])
+        self.pipeline.add('launch', self.phase('launch'),
+                          ['user_data', 'verify'])
+        self.assertTrue(self.pipeline.run())
+        self.assertEqual(sorted(self.calls),
+                         ['keys', 'launch', 'user_data', 'verify'])
+        self.assertTrue(self.calls.index('keys') <
+                        self.calls.index('user_data') <
+                        self.calls.index('launch'))
+        self.assertTrue(self.calls.index('verify') <
+                        self.calls.index('launch'))
+
+    def test_independent_phases_overlap(self):
+        started = threading.Event()
+
+        def first():
+            return started.wait(5) or False
+
+        def second():
+            started.set()
+            return True
+        self.pipeline.add('first', first)
+        self.pipeline.add('second', second)
+        self.assertTrue(self.pipeline.run())
+
+    def test_dependents_of_a_failed_phase_are_skipped(self):
+        self.pipeline.add('keys', self.phase('keys', ok=False))
+        self.pipeline.add('verify', self.phase('verify'))
+        self.pipeline.add('user_data', self.phase('user_data'), ['keys'])
+        self.pipeline.add('launch', self.phase('launch'), ['user_data'])
+        self.assertFalse(self.pipeline.run())
+        self.assertEqual(sorted(self.calls), ['keys', 'verify'])
+        self.assertEqual(self.pipeline.results, {
+            'keys': False,
+            'verify': True,
+            'user_data': False,
+            'launch': False,
+        })
+
+    def test_exceptions_are_raised_after_running_phases(self):
+        def fail():
+            raise RuntimeError('boom')
+        self.pipeline.add('fail', fail)
+        self.pipeline.add('verify', self.phase('verify'))
+        self.pipeline.add('launch', self.phase('launch'), ['fail'])
+        self.assertRaises(RuntimeError, self.pipeline.run)
+        self.assertEqual(self.calls, ['verify'])
+
+    def test_unknown_requirement(self):
+        self.assertRaises(ValueError, self.pipeline.add,
+                          'launch', self.phase('launch'), ['keys'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import email
+import shutil
+import tempfile
+import unittest
+
+import shaker.config
+import shaker.template
+
+
+def payloads(user_data):
+    """Return the contents of the parts of a MIME payload, whose
+    boundary differs between renderings.
+    """
+    message = email.message_from_string(user_data)
+    return [part.get_payload() for part in message.get_payload()]
+
+
+class BatchUserDataTest(unittest.TestCase):
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.base = dict(shaker.config.DEFAULTS)
+        self.base.update({
+            'config_dir': self.config_dir,
+            'salt_master': 'salt.example.com',
+            'domain': 'example.com',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def configs(self, hostnames, **settings):
+        return [dict(self.base, hostname=h, salt_id=h, **settings)
+                for h in hostnames]
+
+    def assertBatchMatchesFullRendering(self, configs):
+        batch = shaker.template.BatchUserData(configs)
+        for config, user_data in zip(configs, batch):
+            full = shaker.template.mime_multipart(
+                shaker.template.UserData(dict(config)).parts())
+            self.assertEqual(payloads(user_data), payloads(full))
+        return batch
+
+    def write_template(self, contents):
+        path = os.path.join(self.config_dir, 'custom-user-script')
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_builtin_templates_use_skeletons(self):
+        batch = self.assertBatchMatchesFullRendering(
+            self.configs(['web01', 'web02', 'web03']))
+        self.assertEqual(len(batch.skeletons), 1)
+        self.assertTrue(all(batch.skeletons.values()))
+
+    def test_conditional_on_host_value_renders_each_host(self):
+        path = self.write_template(
+            "{% if hostname.startswith('db') %}DB{% else %}NOTDB{% endif %}\n")
+        configs = self.configs(['db01', 'web01', 'db02'],
+                               user_data_template=path)
+        batch = self.assertBatchMatchesFullRendering(configs)
+        self.assertEqual(batch.skeletons.values(), [None])
+        self.assertIn('NOTDB', list(batch)[1])
+
+    def test_filtered_host_value_renders_each_host(self):
+        path = self.write_template("{{ hostname|upper }}\n")
+        self.assertBatchMatchesFullRendering(
+            self.configs(['web01', 'web02'], user_data_template=path))
+
+    def test_truth_tests_keep_skeletons(self):
+        path = self.write_template(
+            "{% if hostname and not ssh_import %}{{ hostname }}{% endif %}\n")
+        batch = self.assertBatchMatchesFullRendering(
+            self.configs(['web01', 'web02'], user_data_template=path))
+        self.assertTrue(all(batch.skeletons.values()))
+
+
+class TemplateUsesTest(unittest.TestCase):
+    def uses(self, contents):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        try:
+            return shaker.template.template_uses(path)
+        finally:
+            os.unlink(path)
+
+    def test_printing_and_truth_tests_are_not_uses(self):
+        self.assertEqual(self.uses(
+            "{% if a or not b %}{{ a }}{% elif c %}{{ c }}{% endif %}"),
+            set())
+
+    def test_expressions_are_uses(self):
+        self.assertEqual(self.uses(
+            "{{ a|upper }}{% if b == 'x' %}{% endif %}{% for i in c %}{% endfor %}"),
+            set(['a', 'b', 'c']))
+
+    def test_includes_are_assumed_to_use_everything(self):
+        self.assertEqual(self.uses("{% include 'other' %}"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
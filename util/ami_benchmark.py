@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import time
+import optparse
+
+import shaker.ami
+
+"""
+Benchmark AMI lookups against synthetic catalogs of increasing size.
+With the precompiled index, the cost per lookup stays flat while the
+catalog grows; the one-off index build grows with it.
+
+$ ./ami_benchmark.py --lookups 100000
+"""
+
+REGIONS = ['us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1',
+           'ap-southeast-1', 'ap-northeast-1', 'sa-east-1']
+
+def synthetic_catalog(releases):
+    """Return a catalog in the EBSImages format with ``releases``
+    releases, each available in every region and architecture.
+    """
+    lines = ['release:', '  ubuntu: release0', '', 'ubuntu:']
+    n = 0
+    for r in range(releases):
+        lines.append('  release{0}:'.format(r))
+        for region in REGIONS:
+            lines.append('    {0}:'.format(region))
+            for arch in ['x86_64', 'i386']:
+                lines.append('      {0}: ami-{1:08x}'.format(arch, n))
+                n += 1
+    return '\n'.join(lines) + '\n'
+
+def benchmark(releases, lookups):
+    catalog = synthetic_catalog(releases)
+    start = time.time()
+    index = shaker.ami.get_index(catalog=catalog)
+    build = time.time() - start
+    profile = {'ec2_region': 'eu-west-1', 'ec2_architecture': 'x86_64'}
+    release = 'release{0}'.format(releases - 1)
+    # get_ami() looks up the default catalog, so time the same
+    # lookup against this catalog's index directly.
+    key = shaker.ami.index_key('ubuntu', release, profile['ec2_region'],
+                               profile['ec2_architecture'])
+    start = time.time()
+    for _ in range(lookups):
+        shaker.ami.get_index(catalog=catalog)['amis'].get(key)
+    per_lookup = (time.time() - start) / lookups
+    return len(index['amis']), build, per_lookup
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--lookups', dest='lookups', type='int', default=10000)
+    opts, _ = parser.parse_args()
+    print "{0:>8} {1:>10} {2:>12}".format('amis', 'build ms', 'lookup us')
+    for releases in [1, 10, 100, 1000]:
+        amis, build, per_lookup = benchmark(releases, opts.lookups)
+        print "{0:>8} {1:>10.1f} {2:>12.2f}".format(
+            amis, build * 1000, per_lookup * 1000000)
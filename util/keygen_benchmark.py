@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+import time
+import optparse
+
+import shaker.keys
+
+"""
+Micro-benchmark of the minion key backends, reporting keys/second
+for each installed backend:
+
+$ ./keygen_benchmark.py --count 20 --bits 2048
+"""
+
+def benchmark(backend, count, bits):
+    """Return the keys/second generated serially by the backend.
+    """
+    start = time.time()
+    for _ in range(count):
+        backend.generate_key_pair(bits)
+    return count / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--count', dest='count', type='int', default=10)
+    parser.add_option('--bits', dest='bits', type='int',
+                      default=shaker.keys.KEY_SIZE)
+    opts, _ = parser.parse_args()
+    print "{0:<14} {1:>10}".format('backend', 'keys/sec')
+    for cls in shaker.keys.BACKENDS:
+        if not cls.available():
+            print "{0:<14} {1:>10}".format(cls.name, 'n/a')
+            continue
+        rate = benchmark(cls(), opts.count, opts.bits)
+        print "{0:<14} {1:>10.2f}".format(cls.name, rate)
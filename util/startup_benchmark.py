@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import optparse
+import tempfile
+import subprocess
+
+"""
+Benchmark the cold-start latency of shaker's entry points against a
+budget, exiting non-zero if any exceeds it.  Each entry point runs in
+a fresh interpreter, which also reports the heavy dependencies it
+imported: the fast paths shouldn't import any.
+
+Python 2 has no ``-X importtime``, so imports are timed by a small
+bootstrap wrapping the entry point instead.
+
+$ ./startup_benchmark.py --runs 10 --budget 150
+"""
+
+HEAVY_MODULES = ['boto', 'jinja2', 'yaml', 'M2Crypto', 'cryptography',
+                 'multiprocessing', 'email.mime.multipart']
+
+ENTRY_POINTS = [
+    ('shaker --help', 'shaker', ['--help']),
+    ('shaker --version', 'shaker', ['--version']),
+    ('shaker-terminate', 'shaker-terminate', []),
+    ('shaker-ami-sync --help', 'shaker-ami-sync', ['--help']),
+]
+
+BOOTSTRAP = """
+import sys, time, json, atexit
+start = time.time()
+def report():
+    sys.stderr.write('STARTUP ' + json.dumps({
+        'ms': (time.time() - start) * 1000,
+        'heavy': [m for m in %(heavy)r if m in sys.modules],
+    }) + '\\n')
+atexit.register(report)
+sys.argv = [%(script)r] + %(args)r
+execfile(%(script)r, {'__name__': '__main__'})
+"""
+
+def run(script, args, env):
+    """Run an entry point in a fresh interpreter, returning (wall
+    time in ms, heavy modules imported).
+    """
+    code = BOOTSTRAP % {
+        'heavy': HEAVY_MODULES, 'script': script, 'args': args}
+    start = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-c', code],
+        stdin=open(os.devnull), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env=env)
+    _, err = proc.communicate()
+    elapsed = (time.time() - start) * 1000
+    heavy = []
+    for line in err.splitlines():
+        if line.startswith('STARTUP '):
+            heavy = json.loads(line[len('STARTUP '):])['heavy']
+    return elapsed, heavy
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', dest='runs', type='int', default=5)
+    parser.add_option('--budget', dest='budget', type='float', default=150,
+                      help="Budget in ms per entry point.  Default: %default")
+    opts, _ = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + filter(None, [env.get('PYTHONPATH')]))
+    env['SHAKER_CONFIG_DIR'] = tempfile.mkdtemp()
+    over = False
+    print "{0:<24} {1:>10} {2:>10}  {3}".format(
+        'entry point', 'median ms', 'budget', 'heavy imports')
+    for name, script, args in ENTRY_POINTS:
+        path = os.path.join(root, 'scripts', script)
+        run(path, args, env)  # warm the .pyc files
+        results = [run(path, args, env) for _ in range(opts.runs)]
+        times = sorted(r[0] for r in results)
+        median = times[len(times) // 2]
+        over = over or median > opts.budget
+        print "{0:<24} {1:>10.1f} {2:>10.0f}  {3}".format(
+            name, median, opts.budget, ', '.join(results[-1][1]) or '-')
+    sys.exit(1 if over else 0)